@@ -0,0 +1,140 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import itertools
+import argparse
+import json
+import csv
+import os
+
+
+def expand(spec):
+    """
+    Turn a sweep spec into one run description per parameter combination
+    and replica.
+
+    spec = {
+        "steps": 3600,
+        "replicas": 4,
+        "seed": 0,
+        "parameters": {"num_vehicles": [100, 1000], "vectorized": [True]},
+    }
+
+    Every parameter except num_vehicles is passed to Simulation as config.
+    A dotted name sets one entry of a dict setting, so that signal timings
+    can be swept with e.g. "signal_config.phase_durations" or
+    "signal_config.mode".
+    """
+    parameters = spec.get("parameters", {})
+    names = sorted(parameters)
+    runs = []
+    for values in itertools.product(*(parameters[name] for name in names)):
+        for replica in range(spec.get("replicas", 1)):
+            # Derived from the replica number only, not from the order in
+            # which workers pick the runs up, so every combination sees the
+            # same demand
+            seed = np.random.SeedSequence([spec.get("seed", 0), replica]).generate_state(1)[0]
+            runs.append({
+                "parameters": dict(zip(names, values)),
+                "replica": replica,
+                "seed": int(seed),
+                "steps": spec.get("steps", 3600),
+                "sample_every": spec.get("sample_every", 60),
+            })
+    return runs
+
+
+def sample_speeds(sim, speed_sum, speed_count):
+    if sim.engine is not None:
+        engine = sim.engine
+        slots = np.flatnonzero(engine.active[:engine.size])
+        road = engine.road[slots]
+        speed_sum += np.bincount(road, weights=engine.v[slots], minlength=len(sim.roads))
+        speed_count += np.bincount(road, minlength=len(sim.roads))
+        return
+
+    for i, road in enumerate(sim.roads):
+        for vehicle in road.vehicles:
+            speed_sum[i] += vehicle.v
+            speed_count[i] += 1
+
+
+def run(description):
+    """
+    Run one replica and return its row of the results table.
+    """
+    from simulation import Simulation
+
+    parameters = dict(description["parameters"])
+    num_vehicles = parameters.pop("num_vehicles", 100)
+    config = {"seed": description["seed"], "collect_data": False}
+    for name, value in sorted(parameters.items()):
+        setting, _, key = name.partition(".")
+        if key:
+            config[setting] = dict(config.get(setting, {}), **{key: value})
+        else:
+            config[setting] = value
+
+    sim = Simulation(config)
+    sim.generate_model(num_vehicles=num_vehicles)
+
+    speed_sum = np.zeros(len(sim.roads))
+    speed_count = np.zeros(len(sim.roads))
+    for i in range(description["steps"]):
+        sim.step()
+        if i % description["sample_every"] == 0:
+            sample_speeds(sim, speed_sum, speed_count)
+
+    row = dict(description["parameters"])
+    row["replica"] = description["replica"]
+    row["seed"] = description["seed"]
+    row["t"] = sim.t
+    row["completed_trips"] = sim.completed_trips
+    # Completed trips per hour of simulated time
+    row["throughput"] = sim.completed_trips * 3600 / sim.t
+    row["mean_travel_time"] = sim.total_travel_time / sim.completed_trips if sim.completed_trips else float("nan")
+    row["mean_speed"] = speed_sum.sum() / speed_count.sum() if speed_count.sum() else float("nan")
+    with np.errstate(invalid="ignore"):
+        road_speed = speed_sum / speed_count
+    for road, speed in zip(sim.roads, road_speed):
+        row["speed_%d" % road.unique_id] = speed
+    return row
+
+
+def run_batch(spec, workers=None):
+    """
+    Run every replica of a sweep on a process pool and return the rows of
+    the results table in sweep order.
+    """
+    runs = expand(spec)
+    if workers == 1:
+        return [run(description) for description in runs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(run, runs))
+
+
+def write_table(rows, path):
+    columns = []
+    for row in rows:
+        columns.extend(name for name in row if name not in columns)
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a parameter sweep of Simulation replicas.")
+    parser.add_argument("spec", help="JSON file with the sweep spec")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--out", default="results.csv")
+    args = parser.parse_args()
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+    rows = run_batch(spec, args.workers)
+    write_table(rows, args.out)
+    print("%d runs written to %s" % (len(rows), args.out))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,471 @@
+from simulation import Simulation
+from network import compile_network
+from traffic_signal import TrafficSignal
+from vehicle import Vehicle
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+import numpy as np
+import platform
+import argparse
+import resource
+import gc
+import subprocess
+import hashlib
+import random
+import json
+import sys
+import os
+import time
+
+
+class LegacySimulation(Simulation):
+    """
+    Road transitions as they were done before the road registry:
+    deepcopy of the vehicle and a linear scan over self.roads.
+    """
+    def transition(self, road, lane=0):
+        vehicle = road.lanes[lane][0]
+        if vehicle.current_road_index + 1 < len(vehicle.path):
+            vehicle.current_road_index += 1
+            new_vehicle = deepcopy(vehicle)
+            new_vehicle.x = 0
+            next_road_index = vehicle.path[vehicle.current_road_index]
+            for road_t in self.roads:
+                if road_t.unique_id == next_road_index:
+                    road_t.lanes[0].append(new_vehicle)
+                    break
+        road.lanes[lane].popleft()
+
+
+def random_walk(sim, start, length, rng=random):
+    """
+    Return a path of road ids following the connections of the network.
+    """
+    network = sim.network
+    road_ids = network.road_ids.tolist()
+    path = [start]
+    while len(path) < length:
+        successors = [road_ids[i] for i in network.successors_of(network.index[path[-1]]).tolist()]
+        if not successors:
+            break
+        path.append(rng.choice(successors))
+    return path
+
+
+def populate(sim, vehicles_per_road, path_length):
+    i = 0
+    for road in sim.roads:
+        for _ in range(vehicles_per_road):
+            path = random_walk(sim, road.unique_id, path_length)
+            vehicle = Vehicle(i, sim, {"path": path})
+            road.add(vehicle, 0)
+            sim.schedule.add(vehicle)
+            i += 1
+
+
+def benchmark_transitions(sim_class, transitions, repeats=1, vehicles_per_road=2, path_length=50, seed=0):
+    """
+    Time `transitions` road transitions on the built-in 64 road network,
+    `repeats` times on fresh simulations, and return the number of
+    transitions per second.
+    """
+    random.seed(seed)
+    total = 0
+    elapsed = 0
+    for _ in range(repeats):
+        sim = sim_class()
+        sim.generate_roads()
+        populate(sim, vehicles_per_road, path_length)
+
+        done = 0
+        start = time.perf_counter()
+        while done < transitions:
+            moved = done
+            for road in sim.roads:
+                if len(road.vehicles) == 0:
+                    continue
+                road.vehicles[0].x = road.length
+                sim.transition(road)
+                done += 1
+                if done == transitions:
+                    break
+            if done == moved:
+                break
+        elapsed += time.perf_counter() - start
+        total += done
+    return total / elapsed
+
+
+def signal_scenario(mode, coordinated=False, num_vehicles=400, steps=18000, seed=0):
+    """
+    Run the built-in network with signals at every merge plus a signaled
+    corridor on roads 1, 2, 3 and 4, and return the throughput in trips
+    per hour and the mean delay per trip in seconds.
+    """
+    sim = Simulation({"seed": seed, "vectorized": True, "collect_data": False, "signal_config": {"mode": mode}})
+    sim.generate_roads()
+    # The corridor signals come first, so merge signals leave their roads out
+    for road_id in (1, 2, 3, 4):
+        road = sim.road_by_id[road_id]
+        sim.traffic_lights.append(TrafficSignal(road_id, [[road]], {"cycle_length": [(True,), (False,)], "mode": "fixed"}, sim))
+    sim.generate_traffic_signals()
+    sim.generate_signal_controller()
+    if coordinated:
+        sim.coordinate([1, 2, 3, 4])
+    sim.generate_vehicle(num_vehicles)
+    sim.generate_schedule()
+    sim.generate_engine()
+
+    for i in range(steps):
+        sim.step()
+    return sim.completed_trips * 3600 / sim.t, sim.total_delay / max(sim.completed_trips, 1)
+
+
+def grid_network(size, spacing=100):
+    """
+    Return the description of a size x size grid of two-way streets.
+    """
+    nodes = {}
+    ways = []
+    for i in range(size):
+        for j in range(size):
+            nodes[str(i * size + j)] = [j * spacing, i * spacing]
+    for i in range(size):
+        ways.append({"id": len(ways), "nodes": [i * size + j for j in range(size)]})
+        ways.append({"id": len(ways), "nodes": [j * size + i for j in range(size)]})
+    return {"name": "grid %dx%d" % (size, size), "nodes": nodes, "ways": ways}
+
+
+def scaling_scenario(workers, network, num_vehicles, steps, seed=0):
+    """
+    Step num_vehicles random walkers on network with the engine split over
+    `workers` threads, and return the ticks per second and the final
+    vehicle columns. Regions are stepped apart whatever their size.
+    """
+    sim = Simulation({"seed": seed, "network": network, "vectorized": True, "workers": workers,
+                      "min_region_vehicles": 0, "collect_data": False, "traffic_signals": False})
+    sim.generate_roads()
+    sim.generate_signal_controller()
+    sim.generate_engine()
+    rng = random.Random(seed)
+    for road in rng.sample(sim.roads, num_vehicles):
+        sim.spawn(random_walk(sim, road.unique_id, 1000, rng))
+
+    start = time.perf_counter()
+    for i in range(steps):
+        sim.step()
+    elapsed = time.perf_counter() - start
+    sim.close()
+    return steps / elapsed, sim.vehicle_columns()
+
+
+def benchmark_scaling(max_workers, size=60, num_vehicles=10000, steps=200, seed=0):
+    """
+    Run the same grid scenario with 1 to max_workers workers and check that
+    every run ends in exactly the state of the single-worker run.
+    """
+    network = compile_network(grid_network(size))
+    results = []
+    reference = None
+    for workers in range(1, max_workers + 1):
+        ticks, columns = scaling_scenario(workers, network, num_vehicles, steps, seed)
+        if reference is None:
+            reference = columns
+        identical = all(np.array_equal(a, b) for a, b in zip(columns, reference))
+        results.append((workers, ticks, identical))
+    return results
+
+
+# Seeded scenarios of the benchmark suite. "grid" is the size of a
+# synthetic grid, None meaning the built-in network; vehicles follow
+# random walks on grids and shortest routes on the built-in network.
+SCENARIOS = {
+    "default-10": {"vehicles": 10, "steps": 3000},
+    "default-1k": {"vehicles": 1000, "steps": 600},
+    "default-10k": {"vehicles": 10000, "steps": 100},
+    "default-1k-objects": {"vehicles": 1000, "steps": 60, "vectorized": False},
+    "grid-10": {"grid": 10, "vehicles": 180, "steps": 1000},
+    "grid-20": {"grid": 20, "vehicles": 760, "steps": 500},
+    "grid-40": {"grid": 40, "vehicles": 3120, "steps": 200},
+    "grid-80": {"grid": 80, "vehicles": 12640, "steps": 100},
+    "signals-grid-20-fixed": {"grid": 20, "vehicles": 760, "steps": 500, "signals": "fixed"},
+    "signals-grid-20-actuated": {"grid": 20, "vehicles": 760, "steps": 500, "signals": "actuated"},
+    "grid-40-adaptive": {"grid": 40, "vehicles": 3120, "steps": 20, "max_dt": 0.5},
+    "signals-grid-20-adaptive": {"grid": 20, "vehicles": 760, "steps": 50, "signals": "fixed", "max_dt": 0.5},
+}
+SCENARIO_DEFAULTS = {"grid": None, "signals": None, "vectorized": True, "max_dt": None, "seed": 0}
+
+# Metrics compared against a baseline, and whether higher is better
+METRICS = {
+    "ticks_per_second": True,
+    "simulated_seconds_per_second": True,
+    "updates_per_second": True,
+    "peak_rss_mb": False,
+}
+# Metrics reported but not compared: a spawn takes microseconds, and its
+# median still moves by more than the tolerance between identical runs
+REPORTED_METRICS = {
+    "spawn_seconds": False,
+}
+# Scenarios too short for the default gate: a tick of ten vehicles takes
+# about 100 us, and their ticks/s moves by a third between identical runs.
+# They are run `repeats` times as often and compared with a tolerance of
+# at least `tolerance`.
+NOISY_SCENARIOS = {
+    "default-10": {"repeats": 3, "tolerance": 0.5},
+}
+
+
+# Libraries the headless core must not import
+HEAVY_MODULES = ("mesa", "networkx", "pandas", "scipy", "matplotlib")
+STARTUP_METRICS = ("process_seconds", "import_seconds")
+# Building and stepping a ten-vehicle model takes a few milliseconds and
+# isn't compared either
+REPORTED_STARTUP_METRICS = ("first_step_seconds",)
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+import simulation
+imported = time.perf_counter()
+sim = simulation.Simulation({"seed": 0, "collect_data": False})
+sim.generate_model(10)
+sim.step()
+stepped = time.perf_counter()
+import sys, json
+print(json.dumps({
+    "import_seconds": imported - start,
+    "first_step_seconds": stepped - imported,
+    "heavy_modules": [name for name in %r if name in sys.modules],
+}))
+""" % (HEAVY_MODULES,)
+
+
+def measure_startup(repeats=3):
+    """
+    Start a fresh interpreter that imports simulation and runs one step
+    of the default model, `repeats` times, and return the best wall-clock
+    time of the whole process, of the import and of building and stepping
+    the model, with the heavy libraries that got imported.
+    """
+    runs = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout
+        run = json.loads(output)
+        run["process_seconds"] = time.perf_counter() - start
+        runs.append(run)
+    result = {"heavy_modules": runs[0]["heavy_modules"]}
+    for metric in STARTUP_METRICS + REPORTED_STARTUP_METRICS:
+        values = [run[metric] for run in runs]
+        result[metric] = min(values)
+        result[metric + "_runs"] = values
+    return result
+
+
+def rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20
+
+
+def run_scenario(name):
+    """
+    Build and run one scenario of SCENARIOS and return its measurements.
+    Meant to run in a fresh process so that peak_rss_mb is its own.
+    """
+    spec = dict(SCENARIO_DEFAULTS, **SCENARIOS[name])
+    rss_start = rss_mb()
+    start = time.perf_counter()
+    config = {"seed": spec["seed"], "vectorized": spec["vectorized"], "max_dt": spec["max_dt"],
+              "collect_data": False, "traffic_signals": spec["signals"] is not None,
+              "signal_config": {"mode": spec["signals"]}}
+    if spec["grid"] is not None:
+        config["network"] = compile_network(grid_network(spec["grid"]))
+    sim = Simulation(config)
+    sim.generate_model(0)
+
+    rng = random.Random(spec["seed"])
+    if spec["grid"] is None:
+        paths = [sim.routes.sample(rng) for _ in range(spec["vehicles"])]
+    else:
+        paths = [random_walk(sim, road.unique_id, 1000, rng) for road in rng.sample(sim.roads, spec["vehicles"])]
+    setup = time.perf_counter() - start
+
+    # Collect the garbage of the setup now rather than in a timed section
+    gc.collect()
+    # Spawns are timed one by one and summarized by their median, which
+    # leaves out the few that grow the engine or wait for the collector
+    spawns = []
+    for path in paths:
+        start = time.perf_counter()
+        sim.spawn(path)
+        spawns.append(time.perf_counter() - start)
+
+    gc.collect()
+    updates = 0
+    start = time.perf_counter()
+    for _ in range(spec["steps"]):
+        updates += sim.schedule.get_agent_count()
+        sim.step()
+    elapsed = time.perf_counter() - start
+    simulated = sim.t
+
+    ids, x, y, road = sim.vehicle_columns()
+    digest = hashlib.md5()
+    for column in (ids, x, y, road):
+        digest.update(np.ascontiguousarray(column).tobytes())
+    return {
+        "scenario": spec,
+        "roads": len(sim.roads),
+        "signals": len(sim.traffic_lights),
+        "setup_seconds": setup,
+        "spawn_seconds": float(np.median(spawns)) if spawns else 0.0,
+        "spawns": len(spawns),
+        "ticks_per_second": spec["steps"] / elapsed,
+        "updates_per_second": updates / elapsed,
+        "simulated_seconds_per_second": simulated / elapsed,
+        "peak_rss_mb": rss_mb(),
+        "start_rss_mb": rss_start,
+        "completed_trips": sim.completed_trips,
+        "checksum": digest.hexdigest(),
+    }
+
+
+def run_suite(names=None, repeats=3):
+    """
+    Run every scenario `repeats` times (more for NOISY_SCENARIOS), each in
+    a fresh process, and keep the best value of every metric together with
+    a description of the machine and the startup time.
+    """
+    results = {}
+    for name in names or SCENARIOS:
+        runs = []
+        for _ in range(repeats * NOISY_SCENARIOS.get(name, {}).get("repeats", 1)):
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                runs.append(pool.submit(run_scenario, name).result())
+        best = dict(runs[0])
+        for metric, higher_is_better in dict(METRICS, **REPORTED_METRICS).items():
+            values = [run[metric] for run in runs]
+            best[metric] = max(values) if higher_is_better else min(values)
+            best[metric + "_runs"] = values
+        results[name] = best
+    return {
+        "machine": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+        },
+        "time": time.time(),
+        "startup": measure_startup(repeats),
+        "scenarios": results,
+    }
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Return the regressions of results against baseline: every metric of
+    METRICS more than `tolerance` (or the tolerance of NOISY_SCENARIOS)
+    worse than in the same scenario of the baseline, plus scenarios whose
+    final state changed, and startup times of STARTUP_METRICS or imported
+    libraries that got worse.
+    """
+    regressions = []
+    startup, reference = results.get("startup"), baseline.get("startup")
+    if startup is not None and reference is not None:
+        for metric in STARTUP_METRICS:
+            old, new = reference[metric], startup[metric]
+            change = (new - old) / old if old else 0
+            if change > tolerance:
+                regressions.append("startup: %s %.4g -> %.4g (%+.1f%%)" % (metric, old, new, 100 * change))
+        for name in sorted(set(startup["heavy_modules"]) - set(reference["heavy_modules"])):
+            regressions.append("startup: importing simulation now imports %s" % name)
+    for name, result in results["scenarios"].items():
+        reference = baseline["scenarios"].get(name)
+        if reference is None or reference["scenario"] != result["scenario"]:
+            continue
+        limit = max(tolerance, NOISY_SCENARIOS.get(name, {}).get("tolerance", 0))
+        for metric, higher_is_better in METRICS.items():
+            old, new = reference[metric], result[metric]
+            change = (new - old) / old if old else 0
+            if (change < -limit) if higher_is_better else (change > limit):
+                regressions.append("%s: %s %.4g -> %.4g (%+.1f%%)" % (name, metric, old, new, 100 * change))
+        if reference["checksum"] != result["checksum"]:
+            regressions.append("%s: final state differs from the baseline" % name)
+    return regressions
+
+
+def print_suite(results):
+    startup = results["startup"]
+    print("startup: %.3f s process, %.3f s import, %.3f s first step, heavy modules: %s" % (
+        startup["process_seconds"], startup["import_seconds"], startup["first_step_seconds"],
+        ", ".join(startup["heavy_modules"]) or "none"))
+    print("%-26s %10s %14s %10s %12s %10s" % ("scenario", "ticks/s", "updates/s", "sim s/s", "spawn us", "peak MB"))
+    for name, result in results["scenarios"].items():
+        print("%-26s %10.1f %14.0f %10.1f %12.2f %10.1f" % (
+            name, result["ticks_per_second"], result["updates_per_second"],
+            result["simulated_seconds_per_second"], 1e6 * result["spawn_seconds"], result["peak_rss_mb"]))
+
+
+def report():
+    # Every deepcopy drags along the model and the copies made before it,
+    # so the legacy cost grows exponentially with the number of
+    # transitions; it is sampled over short runs on fresh simulations.
+    before = benchmark_transitions(LegacySimulation, 6, repeats=20)
+    after = benchmark_transitions(Simulation, 100000, path_length=1000)
+    print("road transitions per second")
+    print("  before (deepcopy + linear scan): %12.0f" % before)
+    print("  after  (registry + move):        %12.0f" % after)
+    print("  speedup:                         %12.1fx" % (after / before))
+
+    print("signal control, 5 simulated minutes")
+    for label, mode, coordinated in (
+        ("fixed", "fixed", False),
+        ("fixed + green wave on 1-4", "fixed", True),
+        ("actuated", "actuated", False),
+        ("actuated + green wave on 1-4", "actuated", True),
+    ):
+        throughput, delay = signal_scenario(mode, coordinated)
+        print("  %-30s %8.0f trips/h %8.1f s mean delay" % (label, throughput, delay))
+
+    print("engine scaling, 60x60 grid, 10000 vehicles")
+    results = benchmark_scaling(os.cpu_count())
+    for workers, ticks, identical in results:
+        print("  %2d workers %8.1f ticks/s %6.2fx %s" % (
+            workers, ticks, ticks / results[0][1], "identical" if identical else "DIFFERS"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the simulation.")
+    parser.add_argument("--suite", action="store_true", help="run the scenario suite instead of the comparisons")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), help="suite scenarios to run, all by default")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", help="JSON file to write the suite results to")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative change reported as a regression")
+    args = parser.parse_args()
+
+    if not args.suite:
+        report()
+        return
+
+    results = run_suite(args.scenarios, args.repeats)
+    print_suite(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+from simulation import Simulation
+from traffic_signal import TrafficSignal
+from network import Network
+from demand import DemandModel
+from routing import Rerouter
+from vehicle import Vehicle
+from engine import VehicleEngine
+import numpy as np
+import itertools
+import struct
+import os
+import json
+
+# A checkpoint is MAGIC, the length of a JSON header, the header and the
+# arrays it lists, each starting on an ALIGN byte boundary so that they
+# can be memory-mapped in place
+MAGIC = b"MUCKPT01"
+ALIGN = 64
+
+# Simulation settings stored with the state
+SETTINGS = (
+    "t", "dt", "speed_multiplier", "max_dt", "substep_braking", "substep_interaction", "seed", "vectorized", "workers", "regions",
+    "min_region_vehicles",
+    "lane_change_politeness", "lane_change_threshold", "lane_change_safe_deceleration",
+    "next_vehicle_id", "completed_trips", "total_travel_time", "total_delay",
+)
+VEHICLE_FLOATS = VehicleEngine.FLOAT_FIELDS + ("departure_time",)
+SIGNAL_SETTINGS = (
+    "cycle_length", "phase_durations", "offset", "mode", "min_green", "max_green",
+    "detection_distance", "queue_speed", "passage_time", "slow_distance", "slow_factor",
+    "stop_distance", "current_cycle_index",
+)
+REROUTER_SETTINGS = (
+    "interval", "sample_interval", "smoothing", "threshold", "free_speed", "min_speed",
+    "next_sample", "next_reroute", "searches", "reused", "rerouted",
+)
+
+
+def save(sim, path):
+    """
+    Write the whole state of a simulation to a checkpoint file: clock and
+    counters, network, every lane queue in order with the kinematics and
+    path of its vehicles, signal phases, demand events, rerouting state
+    and RNG state.
+    """
+    meta = {name: getattr(sim, name) for name in SETTINGS}
+    meta["random"] = sim.random.getstate()
+    meta["network_name"] = sim.network.name
+    network = sim.network
+    arrays = {
+        "road_ids": network.road_ids,
+        "road_start": network.start,
+        "road_end": network.end,
+        "road_control": network.control,
+        "road_lanes": network.lanes,
+        "connections": network.connections,
+    }
+
+    # Vehicles in queue order, lane by lane
+    vehicles = []
+    road = []
+    lane = []
+    for road_t in sim.roads:
+        for i, queue in enumerate(road_t.lanes):
+            vehicles.extend(queue)
+            road.extend([road_t.index] * len(queue))
+            lane.extend([i] * len(queue))
+    arrays["vehicle_id"] = np.array([vehicle.unique_id for vehicle in vehicles], dtype=np.int64)
+    arrays["vehicle_road"] = np.array(road, dtype=np.int32)
+    arrays["vehicle_lane"] = np.array(lane, dtype=np.int32)
+    for name in VEHICLE_FLOATS:
+        arrays["vehicle_" + name] = np.array([getattr(vehicle, name) for vehicle in vehicles], dtype=float)
+    arrays["vehicle_stopped"] = np.array([vehicle.stopped for vehicle in vehicles], dtype=bool)
+    arrays["vehicle_current_road_index"] = np.array([vehicle.current_road_index for vehicle in vehicles], dtype=np.int32)
+
+    # Vehicles share their path tuples, so each path is stored once
+    paths = {}
+    path_index = []
+    for vehicle in vehicles:
+        route = tuple(vehicle.path)
+        path_index.append(paths.setdefault(route, len(paths)))
+    arrays["vehicle_path"] = np.array(path_index, dtype=np.int32)
+    arrays["path_offsets"] = np.concatenate(([0], np.cumsum([len(route) for route in paths]))).astype(np.int64)
+    arrays["path_roads"] = np.array([road_id for route in paths for road_id in route], dtype=np.int64)
+
+    meta["signals"] = [
+        dict(
+            {name: getattr(signal, name) for name in SIGNAL_SETTINGS},
+            unique_id=signal.unique_id,
+            roads=[[road_t.unique_id for road_t in group] for group in signal.roads],
+        )
+        for signal in sim.traffic_lights
+    ]
+    controller = sim.signals
+    arrays["signal_phase"] = controller.phase
+    arrays["signal_phase_start"] = controller.phase_start
+    arrays["road_green"] = controller.road_green
+    meta["next_change"] = controller.next_change
+    meta["next_actuation"] = controller.next_actuation
+
+    demand = sim.demand
+    if demand is not None:
+        sequence = next(demand.sequence)
+        demand.sequence = itertools.count(sequence)
+        meta["demand"] = {
+            "flows": demand.flows,
+            "min_entry_gap": demand.min_entry_gap,
+            "retry_interval": demand.retry_interval,
+            "sequence": sequence,
+            "trips": [[list(key), stats] for key, stats in demand.trips.items()],
+        }
+        events = np.array(demand.events, dtype=float).reshape(-1, 4)
+        arrays["demand_events"] = events
+
+    rerouter = sim.rerouter
+    if rerouter is not None:
+        targets = sorted(rerouter.trees)
+        meta["rerouter"] = {name: getattr(rerouter, name) for name in REROUTER_SETTINGS}
+        meta["rerouter"]["targets"] = targets
+        arrays["rerouter_speed"] = rerouter.speed
+        # Trees decide which routes are searched again, so they are state
+        arrays["rerouter_trees"] = np.array([rerouter.trees[target][1] for target in targets], dtype=np.int64).reshape(len(targets), len(sim.roads))
+
+    write(path, meta, arrays)
+
+
+def restore(path, config={}):
+    """
+    Build a Simulation from a checkpoint file. Entries of config override
+    the stored settings, so that several experiments can be forked from
+    one warmed-up state; a "demand" or "rerouter" entry replaces the
+    stored one.
+    """
+    meta, arrays = read(path)
+    # Settings added since the checkpoint was written keep their defaults
+    settings = {name: meta[name] for name in SETTINGS if name in meta}
+    settings.update(config)
+    # Copies, so that nothing keeps the file mapped once restored
+    settings["network"] = Network(
+        np.array(arrays["road_ids"]), np.array(arrays["road_start"]), np.array(arrays["road_end"]),
+        np.array(arrays["connections"]), meta["network_name"],
+        np.array(arrays["road_lanes"]), np.array(arrays["road_control"]),
+    )
+    sim = Simulation(settings)
+    sim.generate_roads()
+
+    for signal in meta["signals"]:
+        groups = [[sim.road_by_id[road_id] for road_id in group] for group in signal["roads"]]
+        signal_config = {name: signal[name] for name in SIGNAL_SETTINGS}
+        signal_config["cycle_length"] = [tuple(phase) for phase in signal["cycle_length"]]
+        sim.traffic_lights.append(TrafficSignal(signal["unique_id"], groups, signal_config, sim))
+    sim.generate_signal_controller()
+    controller = sim.signals
+    controller.phase = np.array(arrays["signal_phase"])
+    controller.phase_start = np.array(arrays["signal_phase_start"])
+    controller.road_green = np.array(arrays["road_green"])
+    controller.next_change = meta["next_change"]
+    controller.next_actuation = meta["next_actuation"]
+
+    offsets = arrays["path_offsets"].tolist()
+    roads = arrays["path_roads"].tolist()
+    paths = [tuple(roads[offsets[i]:offsets[i + 1]]) for i in range(len(offsets) - 1)]
+
+    columns = [arrays["vehicle_" + name].tolist() for name in VEHICLE_FLOATS]
+    ids = arrays["vehicle_id"].tolist()
+    road = arrays["vehicle_road"].tolist()
+    lane = arrays["vehicle_lane"].tolist()
+    stopped = arrays["vehicle_stopped"].tolist()
+    current = arrays["vehicle_current_road_index"].tolist()
+    path_index = arrays["vehicle_path"].tolist()
+    for i in range(len(ids)):
+        # Same attributes as Vehicle.reset, without recomputing derived ones
+        vehicle = Vehicle.__new__(Vehicle)
+        state = vehicle.__dict__
+        state["model"] = sim
+        state["unique_id"] = ids[i]
+        state["path"] = paths[path_index[i]]
+        for name, column in zip(VEHICLE_FLOATS, columns):
+            state[name] = column[i]
+        state["stopped"] = stopped[i]
+        state["current_road_index"] = current[i]
+        state["lane"] = lane[i]
+        sim.roads[road[i]].lanes[lane[i]].append(vehicle)
+        sim.schedule.add(vehicle)
+
+    if sim.vectorized:
+        sim.generate_engine()
+
+    if "demand" in config:
+        if sim.demand is not None:
+            sim.demand.attach(sim)
+    elif "demand" in meta:
+        saved = meta["demand"]
+        demand = DemandModel(saved["flows"], {
+            "min_entry_gap": saved["min_entry_gap"],
+            "retry_interval": saved["retry_interval"],
+        })
+        demand.find_routes(sim)
+        demand.events = [(t, int(sequence), int(i), departure_time) for t, sequence, i, departure_time in arrays["demand_events"].tolist()]
+        demand.sequence = itertools.count(saved["sequence"])
+        demand.trips = {tuple(key): stats for key, stats in saved["trips"]}
+        sim.demand = demand
+
+    if "rerouter" in config:
+        if sim.rerouter is not None:
+            sim.rerouter.attach(sim)
+    elif "rerouter" in meta:
+        saved = meta["rerouter"]
+        rerouter = Rerouter({name: saved[name] for name in REROUTER_SETTINGS})
+        rerouter.attach(sim)
+        rerouter.next_sample = saved["next_sample"]
+        rerouter.next_reroute = saved["next_reroute"]
+        rerouter.speed = np.array(arrays["rerouter_speed"])
+        rerouter.weights = rerouter.length / np.maximum(rerouter.speed, rerouter.min_speed)
+        trees = arrays["rerouter_trees"].tolist()
+        rerouter.trees = {target: (None, next_road, {}) for target, next_road in zip(saved["targets"], trees)}
+        sim.rerouter = rerouter
+
+    # Metrics are not stored; ones given in config count from here
+    if sim.metrics is not None:
+        sim.metrics.attach(sim)
+    if sim.spatial is not None:
+        sim.spatial.attach(sim)
+
+    sim.random.setstate(tuple(tuple(part) if isinstance(part, list) else part for part in meta["random"]))
+    return sim
+
+
+def write(path, meta, arrays):
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays[name] = array
+        layout[name] = {"dtype": array.dtype.str, "shape": array.shape, "offset": offset}
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    header = json.dumps({"meta": meta, "arrays": layout}).encode()
+    start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+
+    # The file may be mapped by a reader, so it is replaced, not rewritten
+    temporary = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(temporary, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            for name, array in arrays.items():
+                f.seek(start + layout[name]["offset"])
+                f.write(array.tobytes())
+            f.truncate(start + offset)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def read(path):
+    """
+    Return the metadata and the arrays of a checkpoint file, the arrays
+    memory-mapped read-only.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a simulation checkpoint" % path)
+        length, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(length))
+    start = -(-(len(MAGIC) + 8 + length) // ALIGN) * ALIGN
+
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        shape = tuple(entry["shape"])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=entry["dtype"])
+            continue
+        arrays[name] = np.memmap(path, dtype=entry["dtype"], mode="r", offset=start + entry["offset"], shape=shape)
+    return header["meta"], arrays
@@ -1,3 +1,28 @@
+import numpy as np
+
+
+def bezier_points(start, end, control, resolution):
+    """
+    Evaluate quadratic Bezier curves at resolution + 1 evenly spaced
+    parameters. start, end and control are (n, 2) arrays; the result has
+    shape (n, resolution + 1, 2).
+    """
+    t = np.linspace(0, 1, resolution + 1)[None, :, None]
+    return (1 - t) ** 2 * start[:, None] + 2 * t * (1 - t) * control[:, None] + t ** 2 * end[:, None]
+
+
+def arc_length_table(start, end, control, resolution=32):
+    """
+    Return the points of quadratic Bezier curves and the arc length from
+    the start of each curve to every point.
+    """
+    points = bezier_points(start, end, control, resolution)
+    delta = np.diff(points, axis=1)
+    s = np.zeros(points.shape[:2])
+    np.cumsum(np.hypot(delta[..., 0], delta[..., 1]), axis=1, out=s[:, 1:])
+    return points, s
+
+
 def curve_points(start, end, control, resolution=5):
     """
     Return a list of points that make up a curve.
@@ -5,15 +30,8 @@ def curve_points(start, end, control, resolution=5):
     if (start[0] - end[0]) * (start[1] -  end[1]) == 0:
         return [start, end]
 
-    path = []
-
-    for i in range(resolution + 1):
-        t = i / resolution
-        x = (1 - t) ** 2 * start[0] + 2 * t * (1 - t) * control[0] + t ** 2 * end[0]
-        y = (1 - t) ** 2 * start[1] + 2 * t * (1 - t) * control[1] + t ** 2 * end[1]
-        path.append((x, y))
-
-    return path
+    points = bezier_points(np.array([start], dtype=float), np.array([end], dtype=float), np.array([control], dtype=float), resolution)
+    return [tuple(point) for point in points[0].tolist()]
 
 def curve_road(start, end, control, resolution=15):
     """
@@ -45,3 +63,123 @@ def turn_road(start, end, control, turn_direction, resolution=15):
         )
     
     return curve_road(start, end, control, resolution)
+
+
+class RoadGeometry:
+    """
+    Centre lines of every road of a network as one polyline table.
+
+    Straight roads are a single segment; curved roads, given by a
+    quadratic Bezier control point, are sampled once into resolution
+    segments. Points are stored road after road with their arc length, so
+    positions along any number of roads are found with one searchsorted
+    and one interpolation.
+    """
+    def __init__(self, start, end, control=None, resolution=32):
+        n = len(start)
+        if control is None:
+            control = np.full((n, 2), np.nan)
+        curved = np.flatnonzero(~np.isnan(control[:, 0]))
+        straight = np.flatnonzero(np.isnan(control[:, 0]))
+
+        counts = np.full(n, 2, dtype=np.int64)
+        counts[curved] = resolution + 1
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.points = np.zeros((self.offsets[-1], 2))
+        self.s = np.zeros(self.offsets[-1])
+
+        first = self.offsets[straight]
+        self.points[first] = start[straight]
+        self.points[first + 1] = end[straight]
+        delta = end[straight] - start[straight]
+        self.s[first + 1] = np.hypot(delta[:, 0], delta[:, 1])
+
+        if len(curved):
+            points, s = arc_length_table(start[curved], end[curved], control[curved], resolution)
+            index = self.offsets[curved][:, None] + np.arange(resolution + 1)
+            self.points[index] = points
+            self.s[index] = s
+
+        self.length = self.s[self.offsets[1:] - 1]
+        # Arc lengths made increasing across the whole table
+        self.base = np.concatenate(([0], np.cumsum(self.length + 1)[:-1]))
+        self.key = self.s + np.repeat(self.base, counts)
+
+        # Direction of the segment starting at every point
+        self.point_x = self.points[:, 0].copy()
+        self.point_y = self.points[:, 1].copy()
+        delta = np.diff(self.points, axis=0, append=self.points[-1:])
+        segment = np.hypot(delta[:, 0], delta[:, 1])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.cos = np.where(segment > 0, delta[:, 0] / segment, 1)
+            self.sin = np.where(segment > 0, delta[:, 1] / segment, 0)
+        self.heading = np.arctan2(self.sin, self.cos)
+
+        # Scratch arrays of locate and project, grown as needed
+        self.work = np.empty((2, 0))
+        self.bounds = np.empty((2, 0), dtype=np.int64)
+
+    def reserve(self, n):
+        if self.work.shape[1] < n:
+            size = max(n, 2 * self.work.shape[1])
+            self.work = np.empty((2, size))
+            self.bounds = np.empty((2, size), dtype=np.int64)
+
+    def locate(self, road, x):
+        """
+        Return the segment of every point at distance x along the given
+        roads.
+        """
+        n = len(road)
+        self.reserve(n)
+        key = self.work[0, :n]
+        # Indices are in range; with mode="clip" take writes straight into
+        # out instead of through a temporary
+        np.take(self.base, road, out=key, mode="clip")
+        key += x
+        k = np.searchsorted(self.key, key, side="right")
+        k -= 1
+        low, high = self.bounds[:, :n]
+        np.take(self.offsets, road, out=low, mode="clip")
+        np.take(self.offsets[1:], road, out=high, mode="clip")
+        high -= 2
+        np.maximum(k, low, out=k)
+        return np.minimum(k, high, out=k)
+
+    def project(self, road, x, side, out_x, out_y, out_heading):
+        """
+        Write the world coordinates and heading (radians) of points at
+        distance x along the given roads, shifted `side` to the right of
+        the centre line, into the out arrays. Points past either end
+        continue along the end segment. Intermediate values live in
+        scratch arrays kept on the geometry; only the segment indices
+        returned by searchsorted are allocated.
+        """
+        k = self.locate(road, x)
+        along, work = self.work[:, :len(k)]
+        np.take(self.s, k, out=along, mode="clip")
+        np.subtract(x, along, out=along)
+        np.take(self.cos, k, out=out_x, mode="clip")
+        out_x *= along
+        np.take(self.point_x, k, out=work, mode="clip")
+        out_x += work
+        np.take(self.sin, k, out=work, mode="clip")
+        work *= side
+        out_x += work
+        np.take(self.sin, k, out=out_y, mode="clip")
+        out_y *= along
+        np.take(self.point_y, k, out=work, mode="clip")
+        out_y += work
+        np.take(self.cos, k, out=work, mode="clip")
+        work *= side
+        out_y -= work
+        np.take(self.heading, k, out=out_heading, mode="clip")
+
+    def position(self, road, x, side=0):
+        """
+        Return the world coordinates of points at distance x along the
+        given roads, shifted `side` to the right of the centre line.
+        """
+        out = np.empty((3, len(road)))
+        self.project(road, x, side, *out)
+        return out[0], out[1]
@@ -0,0 +1,116 @@
+import itertools
+import heapq
+import math
+
+
+class DemandModel:
+    """
+    Origin/destination demand with time-varying arrival rates.
+
+    Each flow is a dict with an origin and a destination road id and a
+    list of (start time in seconds, vehicles per hour) pairs, the rate
+    holding until the next start time:
+
+        DemandModel([
+            {"origin": 1, "destination": 30, "rates": [(0, 300), (1800, 900), (3600, 300)]},
+        ])
+
+    Arrivals are Poisson and kept in a priority queue of spawn events, so a
+    tick with nothing due costs a single comparison. A spawn whose entry is
+    still occupied is retried retry_interval seconds later; its departure
+    time stays the original one.
+    """
+    def __init__(self, flows, config={}):
+        self.flows = flows
+        self.set_default_config()
+
+        for attr, value in config.items():
+            setattr(self, attr, value)
+
+    def set_default_config(self):
+        # Free space needed at the start of the origin road to spawn
+        self.min_entry_gap = 8
+        self.retry_interval = 0.5
+
+        self.events = []
+        self.sequence = itertools.count()
+        # (origin, destination) -> [trips, total travel time, total squared travel time]
+        self.trips = {}
+
+    def attach(self, sim):
+        """
+        Look up the route of every flow and schedule its first arrival.
+        """
+        self.find_routes(sim)
+        for i in range(len(self.flows)):
+            self.schedule_next(i, sim.t)
+
+    def find_routes(self, sim):
+        self.sim = sim
+        self.paths = []
+        for flow in self.flows:
+            path = sim.routes.route(flow["origin"], flow["destination"])
+            if path is None:
+                raise ValueError("road %s can't be reached from road %s" % (flow["destination"], flow["origin"]))
+            self.paths.append(path)
+
+    def schedule_next(self, i, t):
+        t = self.next_arrival(self.flows[i]["rates"], t)
+        if t is not None:
+            heapq.heappush(self.events, (t, next(self.sequence), i, t))
+
+    def next_arrival(self, rates, t):
+        """
+        Return the next arrival after t of a Poisson process with piecewise
+        constant rates, or None when the rate stays at zero.
+        """
+        work = self.sim.random.expovariate(1)
+        for k, (start, rate) in enumerate(rates):
+            end = rates[k + 1][0] if k + 1 < len(rates) else math.inf
+            if end <= t:
+                continue
+            begin = max(start, t)
+            rate = rate / 3600
+            if rate > 0 and begin + work / rate <= end:
+                return begin + work / rate
+            work -= rate * (end - begin)
+        return None
+
+    def step(self, sim):
+        """
+        Spawn every vehicle due by sim.t.
+        """
+        while self.events and self.events[0][0] <= sim.t:
+            t, _, i, departure_time = heapq.heappop(self.events)
+            if t == departure_time:
+                self.schedule_next(i, t)
+            path = self.paths[i]
+            road = sim.road_by_id[path[0]]
+            lane = road.lanes[road.entry_lane()]
+            if len(lane) > 0 and lane[-1].x < self.min_entry_gap:
+                heapq.heappush(self.events, (t + self.retry_interval, next(self.sequence), i, departure_time))
+                continue
+            sim.spawn(path, departure_time)
+
+    def retired(self, vehicle, travel_time):
+        """
+        Add the trip of a retired vehicle to the statistics of its flow.
+        """
+        key = (vehicle.path[0], vehicle.path[-1])
+        stats = self.trips.get(key)
+        if stats is None:
+            stats = self.trips[key] = [0, 0, 0]
+        stats[0] += 1
+        stats[1] += travel_time
+        stats[2] += travel_time * travel_time
+
+    def travel_times(self):
+        """
+        Return the number of trips and the mean and standard deviation of
+        their travel time for every origin/destination pair.
+        """
+        result = {}
+        for key, (trips, total, squares) in self.trips.items():
+            mean = total / trips
+            result[key] = (trips, mean, math.sqrt(max(squares / trips - mean * mean, 0)))
+        return result
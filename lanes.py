@@ -0,0 +1,115 @@
+import numpy as np
+
+# Smallest bumper-to-bumper gap used in the IDM interaction term
+MIN_GAP = 1e-3
+
+
+def acceleration(follower, lead, x, v, l, v_max, a_max, s0, T, sqrt_ab):
+    """
+    IDM acceleration of every vehicle in follower behind the vehicle in
+    lead at the same position, -1 meaning a free road.
+    """
+    has_lead = lead >= 0
+    lead = np.where(has_lead, lead, follower)
+    v_f = v[follower]
+    gap = np.where(has_lead, x[lead] - l[lead] - x[follower], np.inf)
+    s_star = s0[follower] + np.maximum(0, T[follower]*v_f + (v_f - v[lead])*v_f/sqrt_ab[follower])
+    return a_max[follower] * (1 - (v_f/v_max[follower])**4 - (s_star/np.maximum(gap, MIN_GAP))**2)
+
+
+def mobil(vehicles, x, v, l, v_max, a_max, s0, T, sqrt_ab, stopped, lane, lane_low, lane_high, leader,
+          politeness=0.2, threshold=0.1, safe_deceleration=4):
+    """
+    MOBIL lane changes for a batch of vehicles.
+
+    Every argument but vehicles and the three model parameters is indexed
+    by vehicle; vehicles lists the ones present. lane is a lane id unique
+    across the batch, lane_low and lane_high bound the lanes of each
+    vehicle's road and leader is the vehicle ahead in the same lane or -1.
+
+    A vehicle moves to the neighbouring lane with the largest advantage
+    a~c - ac + p (a~n - an + a~o - ao) above threshold, provided its new
+    follower doesn't have to brake harder than safe_deceleration. Changes
+    are only kept when none of the vehicles involved changes lane too and
+    no other vehicle takes the same gap, so they can all be applied at
+    once. Returns the vehicles changing lane, their new lane and their new
+    leader and follower.
+    """
+    args = (x, v, l, v_max, a_max, s0, T, sqrt_ab)
+    empty = np.zeros(0, dtype=np.int64)
+    if len(vehicles) == 0:
+        return empty, empty, empty, empty
+
+    follower = np.full(len(x), -1, dtype=np.int64)
+    behind = vehicles[leader[vehicles] >= 0]
+    follower[leader[behind]] = behind
+
+    # Vehicles sorted by lane, then by position
+    ordered = vehicles[np.lexsort((x[vehicles], lane[vehicles]))]
+    ordered_lane = lane[ordered]
+
+    a_c = acceleration(vehicles, leader[vehicles], *args)
+    old_follower = follower[vehicles]
+    has_old = old_follower >= 0
+    a_o = np.where(has_old, acceleration(old_follower, vehicles, *args), 0)
+    a_o_new = np.where(has_old, acceleration(old_follower, leader[vehicles], *args), 0)
+
+    best = np.full(len(vehicles), -np.inf)
+    target = np.full(len(vehicles), -1, dtype=np.int64)
+    new_leader = np.full(len(vehicles), -1, dtype=np.int64)
+    new_follower = np.full(len(vehicles), -1, dtype=np.int64)
+    for direction in (-1, 1):
+        lane_to = lane[vehicles] + direction
+        allowed = (lane_to >= lane_low[vehicles]) & (lane_to <= lane_high[vehicles]) & ~stopped[vehicles]
+
+        # Number of vehicles before (lane_to, x) in the sorted order: merge
+        # the queries in, ties going after the vehicles
+        keys_lane = np.concatenate((ordered_lane, lane_to))
+        keys_x = np.concatenate((x[ordered], x[vehicles]))
+        query = np.concatenate((np.zeros(len(ordered), dtype=bool), np.ones(len(vehicles), dtype=bool)))
+        merged = np.lexsort((query, keys_x, keys_lane))
+        position = np.empty(len(vehicles), dtype=np.int64)
+        position[merged[query[merged]] - len(ordered)] = np.cumsum(~query[merged])[query[merged]]
+
+        ahead = np.minimum(position, len(ordered) - 1)
+        lead = np.where((position < len(ordered)) & (ordered_lane[ahead] == lane_to), ordered[ahead], -1)
+        back = np.maximum(position - 1, 0)
+        follow = np.where((position > 0) & (ordered_lane[back] == lane_to), ordered[back], -1)
+
+        # The gap found by position must be a gap of the queue
+        has_follow = follow >= 0
+        consistent = np.where(has_follow, leader[follow] == lead, True) & np.where(lead >= 0, follower[lead] == follow, True)
+
+        a_c_new = acceleration(vehicles, lead, *args)
+        a_n = np.where(has_follow, acceleration(follow, lead, *args), 0)
+        a_n_new = np.where(has_follow, acceleration(follow, vehicles, *args), 0)
+        # Cutting in ahead of a vehicle held at a signal would jump the light
+        safe = np.where(has_follow, (a_n_new >= -safe_deceleration) & ~stopped[follow], True)
+
+        gain = a_c_new - a_c + politeness * (a_n_new - a_n + a_o_new - a_o)
+        better = allowed & consistent & safe & (gain > threshold) & (gain > best)
+        best = np.where(better, gain, best)
+        target = np.where(better, lane_to, target)
+        new_leader = np.where(better, lead, new_leader)
+        new_follower = np.where(better, follow, new_follower)
+
+    changing = target >= 0
+    if not changing.any():
+        return empty, empty, empty, empty
+
+    is_changing = np.zeros(len(x), dtype=bool)
+    is_changing[vehicles[changing]] = True
+    involved = (
+        ((old_follower >= 0) & is_changing[old_follower])
+        | ((new_leader >= 0) & is_changing[new_leader])
+        | ((new_follower >= 0) & is_changing[new_follower])
+    )
+    keep = np.flatnonzero(changing & ~involved)
+
+    # One vehicle per gap, the one furthest ahead
+    keep = keep[np.lexsort((-x[vehicles[keep]], new_leader[keep], target[keep]))]
+    first = np.ones(len(keep), dtype=bool)
+    first[1:] = (target[keep][1:] != target[keep][:-1]) | (new_leader[keep][1:] != new_leader[keep][:-1])
+    keep = np.sort(keep[first])
+
+    return vehicles[keep], target[keep], new_leader[keep], new_follower[keep]
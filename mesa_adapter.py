@@ -0,0 +1,27 @@
+from simulation import Simulation
+from mesa import Model
+from mesa.datacollection import DataCollector
+
+
+class MesaSimulation(Simulation, Model):
+    """
+    A Simulation that is also a mesa Model, for mesa's batch runner and
+    visualization. Keyword arguments are settings, as in the config of a
+    Simulation, and num_vehicles random vehicles are generated. Vehicle
+    paths are collected by a mesa DataCollector, so agent reporters can
+    be added to it.
+    """
+    def __init__(self, num_vehicles=0, **config):
+        Simulation.__init__(self, config)
+        self.running = True
+        self.current_id = 0
+        self.datacollector = DataCollector(
+            model_reporters={"data": lambda m: m.vehicle_path()}
+        )
+        self.generate_model(num_vehicles)
+
+    def step(self):
+        Simulation.step(self)
+        # Vehicles are stepped by their roads, not by the schedule
+        self.schedule.steps += 1
+        self.schedule.time = self.t
@@ -0,0 +1,212 @@
+import numpy as np
+
+
+class TrafficMetrics:
+    """
+    Running traffic statistics, updated as vehicles enter and leave roads.
+
+    Every exit adds to the flow of the road and, when the vehicle was seen
+    entering it, to a histogram of the speed it drove the road at (its
+    length over the time spent on it), from which means and percentiles
+    are read. The number of vehicles on each road is kept as they come and
+    go, and integrated over time only when it changes. Finished trips are
+    kept vehicle by vehicle.
+
+    Set as the simulation's metrics, every interval seconds a row with the
+    flow, mean occupancy and mean speed of each road over the interval
+    and its current signal queue is added to the time series.
+    """
+    def __init__(self, config={}):
+        self.set_default_config()
+
+        for attr, value in config.items():
+            setattr(self, attr, value)
+
+    def set_default_config(self):
+        # Seconds between rows of the time series
+        self.interval = 60
+        # Speed histogram bins in m/s, the last one taking every faster
+        # vehicle
+        self.speed_bin = 0.5
+        self.max_speed = 40
+
+    def attach(self, sim):
+        """
+        Start counting from the current state of a simulation. Vehicles
+        already on a road are counted as on it, but only count towards
+        speeds from the next road they enter.
+        """
+        self.road_ids = np.array([road.unique_id for road in sim.roads])
+        self.length = [road.length for road in sim.roads]
+        self.bins = int(np.ceil(self.max_speed / self.speed_bin))
+        n = len(sim.roads)
+
+        self.entered = {}
+        self.count = [len(road.vehicles) for road in sim.roads]
+        self.occupancy_time = [0.0] * n
+        self.changed = [sim.t] * n
+        self.flow = [0] * n
+        self.timed = [0] * n
+        self.speed_total = [0.0] * n
+        self.speed_histogram = [0] * (n * self.bins)
+
+        self.trip_ids = []
+        self.trip_departures = []
+        self.trip_arrivals = []
+        self.trip_delays = []
+
+        self.start = sim.t
+        self.next_row = sim.t + self.interval
+        self.rows = {name: [] for name in ("flow", "occupancy", "speed", "queue")}
+        self.row_times = []
+        self.last_row = (sim.t, np.zeros(n), np.zeros(n), np.zeros(n), np.zeros(n))
+
+    def enter(self, road, vehicle, t):
+        self.occupancy_time[road] += self.count[road] * (t - self.changed[road])
+        self.changed[road] = t
+        self.count[road] += 1
+        self.entered[vehicle] = t
+
+    def leave(self, road, vehicle, t):
+        self.occupancy_time[road] += self.count[road] * (t - self.changed[road])
+        self.changed[road] = t
+        self.count[road] -= 1
+        self.flow[road] += 1
+        entered = self.entered.pop(vehicle, None)
+        if entered is not None and t > entered:
+            speed = self.length[road] / (t - entered)
+            self.timed[road] += 1
+            self.speed_total[road] += speed
+            self.speed_histogram[road * self.bins + min(int(speed / self.speed_bin), self.bins - 1)] += 1
+
+    def retired(self, vehicle, t, delay):
+        self.trip_ids.append(vehicle.unique_id)
+        self.trip_departures.append(vehicle.departure_time)
+        self.trip_arrivals.append(t)
+        self.trip_delays.append(delay)
+
+    def collect(self, sim):
+        if sim.t >= self.next_row:
+            self.add_row(sim)
+            self.next_row += self.interval
+
+    def occupancy(self, t):
+        """
+        Return the time integral of the number of vehicles on each road up
+        to time t.
+        """
+        count = np.array(self.count, dtype=float)
+        return np.array(self.occupancy_time) + count * (t - np.array(self.changed))
+
+    def queue(self, sim):
+        """
+        Return the number of vehicles on every road slower than the queue
+        speed of its signal, zero on roads without a signal.
+        """
+        signals = sim.signals
+        n = len(sim.roads)
+        engine = sim.engine
+        if engine is not None:
+            road = engine.road[:engine.size]
+            queued = engine.active[:engine.size] & (engine.v[:engine.size] < signals.road_queue_speed[road])
+            return np.bincount(road[queued], minlength=n)
+        queue = np.zeros(n, dtype=np.int64)
+        for i in signals.signaled.tolist():
+            speed = signals.road_queue_speed[i]
+            queue[i] = sum(vehicle.v < speed for vehicle in sim.roads[i].vehicles)
+        return queue
+
+    def add_row(self, sim):
+        t = sim.t
+        last_t, last_flow, last_occupancy, last_timed, last_speed = self.last_row
+        flow = np.array(self.flow, dtype=float)
+        occupancy = self.occupancy(t)
+        timed = np.array(self.timed, dtype=float)
+        speed = np.array(self.speed_total)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.rows["flow"].append(flow - last_flow)
+            self.rows["occupancy"].append((occupancy - last_occupancy) / (t - last_t))
+            self.rows["speed"].append((speed - last_speed) / (timed - last_timed))
+        self.rows["queue"].append(self.queue(sim))
+        self.row_times.append(t)
+        self.last_row = (t, flow, occupancy, timed, speed)
+
+    def speed_percentile(self, q):
+        """
+        Return the q-th percentile of the speed on every road, interpolated
+        within histogram bins, NaN on roads nobody has driven yet.
+        """
+        histogram = np.array(self.speed_histogram, dtype=float).reshape(-1, self.bins)
+        cumulative = histogram.cumsum(axis=1)
+        target = cumulative[:, -1] * q / 100
+        bin = np.minimum((cumulative < target[:, None]).sum(axis=1), self.bins - 1)
+        rows = np.arange(len(histogram))
+        before = cumulative[rows, bin] - histogram[rows, bin]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            within = np.where(histogram[rows, bin] > 0, (target - before) / histogram[rows, bin], 0)
+        return np.where(cumulative[:, -1] > 0, (bin + within) * self.speed_bin, np.nan)
+
+    def trips(self):
+        """
+        Return the id, departure time, arrival time, travel time and delay
+        of every finished trip.
+        """
+        departures = np.array(self.trip_departures, dtype=float)
+        arrivals = np.array(self.trip_arrivals, dtype=float)
+        return {
+            "id": np.array(self.trip_ids, dtype=np.int64),
+            "departure": departures,
+            "arrival": arrivals,
+            "travel_time": arrivals - departures,
+            "delay": np.array(self.trip_delays, dtype=float),
+        }
+
+    def snapshot(self, sim):
+        """
+        Return the statistics of every road since attach and of the whole
+        network, at the current tick.
+        """
+        t = sim.t
+        timed = np.array(self.timed)
+        travel_time = self.trips()["travel_time"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            speed = np.array(self.speed_total) / timed
+            occupancy = self.occupancy(t) / (t - self.start)
+        return {
+            "t": t,
+            "road_ids": self.road_ids,
+            "flow": np.array(self.flow),
+            "vehicles": np.array(self.count),
+            "occupancy": occupancy,
+            "speed": speed,
+            "speed_p50": self.speed_percentile(50),
+            "speed_p90": self.speed_percentile(90),
+            "queue": self.queue(sim),
+            "network": {
+                "vehicles": sum(self.count),
+                "exits": sum(self.flow),
+                "speed": sum(self.speed_total) / max(timed.sum(), 1),
+                "trips": len(travel_time),
+                "travel_time": travel_time.mean() if len(travel_time) else np.nan,
+                "travel_time_p90": np.percentile(travel_time, 90) if len(travel_time) else np.nan,
+            },
+        }
+
+    def series(self):
+        """
+        Return the time series as arrays with one row per interval and one
+        column per road, in float32.
+        """
+        n = len(self.road_ids)
+        series = {"t": np.array(self.row_times), "road_ids": self.road_ids}
+        for name, rows in self.rows.items():
+            series[name] = np.array(rows, dtype=np.float32).reshape(-1, n)
+        return series
+
+    def save(self, path):
+        """
+        Write the time series and the finished trips to a compressed .npz
+        file.
+        """
+        trips = {"trip_" + name: column for name, column in self.trips().items()}
+        np.savez_compressed(path, **self.series(), **trips)
@@ -0,0 +1,251 @@
+from curve import RoadGeometry
+import numpy as np
+import json
+import os
+
+DEFAULT_NETWORK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "networks", "default.json")
+
+
+class NetworkError(ValueError):
+    """
+    Raised with every problem found while validating a network.
+    """
+    def __init__(self, problems):
+        self.problems = problems
+        super().__init__("invalid road network:\n  " + "\n  ".join(problems))
+
+
+class Network:
+    """
+    A road network compiled into flat arrays.
+
+    Roads are numbered by their position in the file. Successors are stored
+    in CSR form: the roads reachable from road i are
+    successors[successor_offsets[i]:successor_offsets[i + 1]], and the
+    matching weights (the length of road i) are in successor_weights.
+    Curved roads have a Bezier control point in control, NaN otherwise,
+    and their length is their arc length.
+    """
+    def __init__(self, road_ids, start, end, connections, name=None, lanes=None, control=None):
+        self.name = name
+        self.road_ids = road_ids
+        self.start = start
+        self.end = end
+        self.lanes = np.ones(len(road_ids), dtype=np.int64) if lanes is None else lanes
+        self.control = np.full((len(road_ids), 2), np.nan) if control is None else control
+
+        self.geometry = RoadGeometry(start, end, self.control)
+        self.length = self.geometry.length
+
+        self.index = {road_id: i for i, road_id in enumerate(road_ids.tolist())}
+        self.connections = connections
+
+        # Connections come in as road ids; sort them by source road index
+        order = np.argsort(road_ids, kind="stable")
+        sorted_ids = road_ids[order]
+        position = np.searchsorted(sorted_ids, connections).clip(0, len(road_ids) - 1)
+        self.known = sorted_ids[position] == connections
+        edges = order[position]
+        edges = edges[np.argsort(edges[:, 0], kind="stable")]
+        self.edges = edges
+
+        self.successors = edges[:, 1].copy()
+        counts = np.bincount(edges[:, 0], minlength=len(road_ids))
+        self.successor_offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.successor_weights = self.length[edges[:, 0]]
+
+    def __len__(self):
+        return len(self.road_ids)
+
+    def successors_of(self, i):
+        """
+        Return the indices of the roads following road i.
+        """
+        return self.successors[self.successor_offsets[i]:self.successor_offsets[i + 1]]
+
+    def connection_gaps(self):
+        """
+        Return, for every connection, the distance between the end of the
+        first road and the start of the second.
+        """
+        delta = self.start[self.edges[:, 1]] - self.end[self.edges[:, 0]]
+        return np.hypot(delta[:, 0], delta[:, 1])
+
+    def components(self):
+        """
+        Return a component label per road, ignoring connection direction.
+        """
+        parent = list(range(len(self)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for a, b in self.edges.tolist():
+            a, b = find(a), find(b)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+        return np.array([find(i) for i in range(len(self))])
+
+    def validate(self, max_gap=1.0, max_components=1):
+        """
+        Raise NetworkError listing every duplicate or degenerate road,
+        connection to an unknown road, road without any connection, a
+        network split into more than max_components disconnected parts
+        (unless max_components is None) and, unless max_gap is None,
+        connection whose roads don't meet within max_gap.
+        """
+        problems = []
+
+        ids, counts = np.unique(self.road_ids, return_counts=True)
+        for road_id in ids[counts > 1]:
+            problems.append("road %d is defined more than once" % road_id)
+        for i in np.flatnonzero(~(self.length > 0)):
+            problems.append("road %d has zero length" % self.road_ids[i])
+        for i in np.flatnonzero(self.lanes < 1):
+            problems.append("road %d has no lanes" % self.road_ids[i])
+
+        unknown = ~self.known.all(axis=1)
+        for a, b in self.connections[unknown].tolist():
+            problems.append("connection %d -> %d uses an unknown road" % (a, b))
+        if unknown.any():
+            raise NetworkError(problems)
+
+        for a, b in self.edges[self.edges[:, 0] == self.edges[:, 1]].tolist():
+            problems.append("road %d is connected to itself" % self.road_ids[a])
+
+        connected = np.zeros(len(self), dtype=bool)
+        connected[self.edges.ravel()] = True
+        for i in np.flatnonzero(~connected):
+            problems.append("road %d is not connected to any other road" % self.road_ids[i])
+
+        if max_components is not None:
+            labels, first = np.unique(self.components(), return_index=True)
+            if len(labels) > max_components:
+                problems.append("the network has %d disconnected parts, starting at roads %s" % (
+                    len(labels), ", ".join(str(road_id) for road_id in self.road_ids[np.sort(first)].tolist())))
+
+        if max_gap is not None:
+            gaps = self.connection_gaps()
+            for (a, b), gap in zip(self.edges[gaps > max_gap].tolist(), gaps[gaps > max_gap].tolist()):
+                problems.append("road %d ends %.1f from the start of road %d" % (self.road_ids[a], gap, self.road_ids[b]))
+
+        if problems:
+            raise NetworkError(problems)
+
+    def partition(self, regions):
+        """
+        Split the roads into `regions` spatial regions of nearly equal size
+        by recursive bisection of their midpoints along the longer side,
+        and return the region of every road.
+        """
+        middle = (self.start + self.end) / 2
+        region = np.zeros(len(self), dtype=np.int16)
+        parts = [(np.arange(len(self)), regions, 0)]
+        while parts:
+            roads, count, first = parts.pop()
+            if count == 1 or len(roads) <= 1:
+                region[roads] = first
+                continue
+            points = middle[roads]
+            axis = np.argmax(points.max(axis=0) - points.min(axis=0))
+            order = roads[np.argsort(points[:, axis], kind="stable")]
+            left = count // 2
+            cut = len(roads) * left // count
+            parts.append((order[:cut], left, first))
+            parts.append((order[cut:], count - left, first + left))
+        return region
+
+    def graph(self):
+        """
+        Return the network as a networkx DiGraph of road ids weighted by
+        the length of the road being left.
+        """
+        import networkx as nx
+
+        graph = nx.DiGraph()
+        graph.add_nodes_from(self.road_ids.tolist())
+        a = self.road_ids[self.edges[:, 0]].tolist()
+        b = self.road_ids[self.edges[:, 1]].tolist()
+        weights = self.successor_weights.tolist()
+        graph.add_weighted_edges_from(zip(a, b, weights))
+        return graph
+
+
+def compile_network(data, max_gap=1.0, max_components=1):
+    """
+    Compile and validate a network description.
+
+    {
+        "roads": [{"id": 1, "start": [x, y], "end": [x, y], "lanes": 2}, ...],
+        "connections": [[1, 2], ...],
+    }
+
+    "lanes" is optional and defaults to 1. A road with a "control" point
+    is a quadratic Bezier curve from start to end. An OpenStreetMap-style
+    description with "nodes" (id -> [x, y]) and "ways" (id, list of node
+    ids, optional "oneway" and "lanes" per direction) is also accepted:
+    every segment of a way becomes a road, in both directions unless the
+    way is one-way, and roads meeting at a node are connected except for
+    U-turns. "max_connection_gap" and "max_components" entries override
+    max_gap and max_components.
+    """
+    max_gap = data.get("max_connection_gap", max_gap)
+    max_components = data.get("max_components", max_components)
+    if "ways" in data:
+        road_ids, start, end, connections, lanes = _compile_ways(data)
+        control = None
+    else:
+        roads = data["roads"]
+        road_ids = np.array([road["id"] for road in roads], dtype=np.int64)
+        start = np.array([road["start"] for road in roads], dtype=float).reshape(-1, 2)
+        end = np.array([road["end"] for road in roads], dtype=float).reshape(-1, 2)
+        connections = np.array(data.get("connections", []), dtype=np.int64).reshape(-1, 2)
+        lanes = np.array([road.get("lanes", 1) for road in roads], dtype=np.int64)
+        control = np.array([road.get("control", [np.nan, np.nan]) for road in roads], dtype=float).reshape(-1, 2)
+
+    network = Network(road_ids, start, end, connections, data.get("name"), lanes, control)
+    network.validate(max_gap, max_components)
+    return network
+
+
+def _compile_ways(data):
+    node_ids = list(data["nodes"])
+    node_index = {node_id: i for i, node_id in enumerate(node_ids)}
+    coordinates = np.array([data["nodes"][node_id] for node_id in node_ids], dtype=float).reshape(-1, 2)
+
+    # One road per way segment and direction
+    tail = []
+    head = []
+    lanes = []
+    for way in data["ways"]:
+        nodes = [node_index[str(node)] for node in way["nodes"]]
+        tail.extend(nodes[:-1])
+        head.extend(nodes[1:])
+        if not way.get("oneway", False):
+            tail.extend(nodes[1:])
+            head.extend(nodes[:-1])
+        lanes.extend([way.get("lanes", 1)] * (len(tail) - len(lanes)))
+    tail = np.array(tail, dtype=np.int64)
+    head = np.array(head, dtype=np.int64)
+    road_ids = np.arange(1, len(tail) + 1, dtype=np.int64)
+
+    # Road a connects to road b when a ends where b starts, unless b
+    # goes straight back
+    by_tail = np.argsort(tail, kind="stable")
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(tail, minlength=len(node_ids)))))
+    counts = offsets[head + 1] - offsets[head]
+    a = np.repeat(np.arange(len(tail)), counts)
+    first = np.repeat(offsets[head], counts)
+    b = by_tail[first + np.arange(len(a)) - np.repeat(np.cumsum(counts) - counts, counts)]
+    keep = head[b] != tail[a]
+    connections = np.column_stack((road_ids[a[keep]], road_ids[b[keep]]))
+
+    return road_ids, coordinates[tail], coordinates[head], connections, np.array(lanes, dtype=np.int64)
+
+
+def load_network(path=DEFAULT_NETWORK, max_gap=1.0, max_components=1):
+    with open(path) as f:
+        return compile_network(json.load(f), max_gap, max_components)
@@ -0,0 +1,180 @@
+from time import perf_counter
+import numpy as np
+import json
+import os
+
+# Phases of Simulation.step, in order. The sub-steps of an adaptive step
+# interleave motion, signals, lane changes and transitions, so they are
+# timed as a whole as adaptive_step.
+PHASES = ("signal_control", "demand", "rerouting", "motion", "signal_rules", "lane_changes", "transitions", "collection", "adaptive_step")
+COUNTERS = ("ticks", "vehicles_stepped", "transitions", "lane_changes", "spawns", "retirements", "stops", "slows")
+
+
+class Profiler:
+    """
+    Opt-in instrumentation of Simulation.step.
+
+    Set as the simulation's profiler, it is told by Simulation.step when
+    each phase ends, adding the wall-clock time of each phase and counting
+    vehicles stepped, transitions, lane changes, spawns, retirements and
+    the stops and slow-downs issued at red lights. With log set, a JSON
+    line with the totals of the last `every` ticks is written to it (a
+    path or an open file). A simulation without a profiler only pays for
+    one test per phase.
+    """
+    def __init__(self, config={}):
+        self.set_default_config()
+
+        for attr, value in config.items():
+            setattr(self, attr, value)
+
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.logged_seconds = dict(self.seconds)
+        self.logged_counts = dict(self.counts)
+        if isinstance(self.log, str):
+            self.log = open(self.log, "a")
+
+    def set_default_config(self):
+        self.log = None
+        self.every = 60
+        # Prefix of the exported metric names
+        self.namespace = "movilidad"
+
+    def start(self, sim):
+        self.spawned = sim.next_vehicle_id
+        self.retired = sim.completed_trips
+        self.last = perf_counter()
+
+    def end_phase(self, sim, name, count):
+        self.seconds[name] += perf_counter() - self.last
+        counts = self.counts
+        if count:
+            counts[name] += count
+        if name == "motion":
+            counts["vehicles_stepped"] += sim.schedule.get_agent_count()
+            self.hold_signals(sim)
+        elif name == "signal_rules":
+            self.count_signals(sim)
+        # The bookkeeping above isn't part of the next phase
+        self.last = perf_counter()
+
+    def count(self, name, count):
+        """
+        Add to a counter from inside a phase, such as the sub-steps of an
+        adaptive step.
+        """
+        self.counts[name] += count
+
+    def hold_signals(self, sim):
+        """
+        Remember which vehicles are stopped and slowed before the signal
+        rules run.
+        """
+        started = perf_counter()
+        self.held = self.signal_state(sim)
+        self.last += perf_counter() - started
+
+    def count_signals(self, sim):
+        """
+        Count the stops and slow-downs issued since hold_signals.
+        """
+        # Only vehicles at the head of a lane are ever stopped or slowed
+        started = perf_counter()
+        stopped, slowed = self.held
+        stopped_after, slowed_after = self.signal_state(sim)
+        self.counts["stops"] += int(np.count_nonzero(stopped_after & ~stopped))
+        self.counts["slows"] += int(np.count_nonzero(slowed_after & ~slowed))
+        self.last += perf_counter() - started
+
+    def finish(self, sim):
+        counts = self.counts
+        counts["ticks"] += 1
+        counts["spawns"] += sim.next_vehicle_id - self.spawned
+        counts["retirements"] += sim.completed_trips - self.retired
+        if self.log is not None and counts["ticks"] % self.every == 0:
+            self.write_log(sim.t)
+
+    def signal_state(self, sim):
+        """
+        Return whether every vehicle that can be held by a signal is
+        stopped and whether it is slowed down.
+        """
+        engine = sim.engine
+        if engine is not None:
+            heads = engine.lane_head[engine.lane_head >= 0]
+            return engine.stopped[heads], engine.v_max[heads] < engine._v_max[heads]
+        heads = [queue[0] for road in sim.roads if road.has_traffic_signal for queue in road.lanes if len(queue) > 0]
+        stopped = np.array([vehicle.stopped for vehicle in heads], dtype=bool)
+        slowed = np.array([vehicle.v_max < vehicle._v_max for vehicle in heads], dtype=bool)
+        return stopped, slowed
+
+    def write_log(self, t):
+        """
+        Write the phase times and counts since the previous line as one
+        JSON line.
+        """
+        record = {
+            "t": t,
+            "seconds": {name: self.seconds[name] - self.logged_seconds[name] for name in PHASES},
+            "counts": {name: self.counts[name] - self.logged_counts[name] for name in COUNTERS},
+        }
+        self.log.write(json.dumps(record) + "\n")
+        self.log.flush()
+        self.logged_seconds = dict(self.seconds)
+        self.logged_counts = dict(self.counts)
+
+    def summary(self):
+        """
+        Return the totals so far, with the mean time of each phase per tick.
+        """
+        ticks = max(self.counts["ticks"], 1)
+        return {
+            "seconds": dict(self.seconds),
+            "seconds_per_tick": {name: value / ticks for name, value in self.seconds.items()},
+            "counts": dict(self.counts),
+        }
+
+    def report(self):
+        """
+        Return a table of the time spent in each phase.
+        """
+        total = sum(self.seconds.values())
+        ticks = max(self.counts["ticks"], 1)
+        lines = ["%-16s %10s %10s %7s" % ("phase", "total s", "ms/tick", "share")]
+        for name in PHASES:
+            value = self.seconds[name]
+            lines.append("%-16s %10.3f %10.4f %6.1f%%" % (name, value, 1000 * value / ticks, 100 * value / total if total else 0))
+        lines.append("")
+        for name in COUNTERS:
+            lines.append("%-16s %10d" % (name, self.counts[name]))
+        return "\n".join(lines)
+
+    def prometheus(self):
+        """
+        Return the totals in the Prometheus text exposition format.
+        """
+        ns = self.namespace
+        lines = [
+            "# HELP %s_step_phase_seconds_total Wall-clock time spent in each phase of a simulation step." % ns,
+            "# TYPE %s_step_phase_seconds_total counter" % ns,
+        ]
+        for name in PHASES:
+            lines.append('%s_step_phase_seconds_total{phase="%s"} %r' % (ns, name, self.seconds[name]))
+        for name in COUNTERS:
+            lines.append("# TYPE %s_%s_total counter" % (ns, name))
+            lines.append("%s_%s_total %d" % (ns, name, self.counts[name]))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """
+        Write the totals to a Prometheus text file, replacing it atomically
+        so that a collector never reads it half written.
+        """
+        with open(path + ".tmp", "w") as f:
+            f.write(self.prometheus())
+        os.replace(path + ".tmp", path)
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
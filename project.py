@@ -1,40 +1,12 @@
 from mesa import Agent, Model
-from mesa.time import RandomActivation
 from mesa.space import MultiGrid
 from mesa.datacollection import DataCollector
 import math
 import random
+from scheduler import Scheduler
 
 
 class Car(Agent):
-    """A schedule that activates each agent once per step, in random order."""
-    def __init__(self):
-        self.agent_buffer = []
-
-    def add(self, agent):
-        """Add an agent to the schedule."""
-        self.agent_buffer.append(agent)
-
-    def remove(self, agent):
-        """Remove all instances of a given agent from the schedule."""
-        while agent in self.agent_buffer:
-            self.agent_buffer.remove(agent)
-
-    def get_num_agents(self):
-        return len(self.agent_buffer)
-
-    def get_num_agents_by_status(self, status):
-        count = 0
-        for agent in self.agent_buffer:
-            if agent.status == status:
-                count += 1
-        return count
-
-    def step(self):
-        for agent in self.agent_buffer:
-            agent.activate()
-        self.agent_buffer = []
-
     def __init__(self, unique_id, model):
         super().__init__(unique_id, model)
         self.x = 0
@@ -108,7 +80,7 @@ class TrafficModel(Model):
             self.cars.append(Car(i, self))
 
     def generate_schedule(self):
-        self.schedule = RandomActivation(self)
+        self.schedule = Scheduler(self)
         for agent in self.traffic_lights:
             self.schedule.add(agent)
         for agent in self.cars:
@@ -134,7 +106,7 @@ class RandomActivation(Model):
     """
     def __init__(self, num_agents=100):
         self.num_agents = num_agents
-        self.schedule = RandomActivationSchedule()
+        self.schedule = Scheduler(self)
         self.running = True
         self.datacollector = DataCollector(
             {"Activated": lambda m: m.schedule.get_num_agents_by_status(True)})
@@ -151,35 +123,6 @@ class RandomActivation(Model):
             self.step()
 
 
-class RandomActivationSchedule(object):
-    """A schedule that activates each agent once per step, in random order."""
-    def __init__(self):
-        self.agent_buffer = []
-
-    def add(self, agent):
-        """Add an agent to the schedule."""
-        self.agent_buffer.append(agent)
-
-    def remove(self, agent):
-        """Remove all instances of a given agent from the schedule."""
-        while agent in self.agent_buffer:
-            self.agent_buffer.remove(agent)
-
-    def get_num_agents(self):
-        return len(self.agent_buffer)
-
-    def get_num_agents_by_status(self, status):
-        count = 0
-        for agent in self.agent_buffer:
-            if agent.status == status:
-                count += 1
-        return count
-
-    def step(self):
-        for agent in self.agent_buffer:
-            agent.activate()
-        self.agent_buffer = []
-
 def main():
     model = TrafficModel(100, 100, 1)
     model.generate_model(100, 100, 1, 1, 1)
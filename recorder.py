@@ -0,0 +1,263 @@
+import numpy as np
+import json
+import os
+
+# One raw binary file per column, readable back with np.memmap
+COLUMNS = {
+    "id": np.int32,
+    "x": np.float32,
+    "y": np.float32,
+    "road": np.int32,
+}
+FRAME_COLUMNS = {
+    "t": np.float64,
+    "start": np.int64,
+    "count": np.int32,
+}
+# Per-vehicle index saved by TrajectoryReader
+INDEX_FILES = ("index_rows.npy", "index_ids.npy", "index_offsets.npy")
+
+
+class DataCollector:
+    """
+    Collects model reporters every tick in memory, like the mesa
+    DataCollector without agent reporters or tables. pandas is only
+    imported by get_model_vars_dataframe.
+    """
+    def __init__(self, model_reporters={}):
+        self.model_reporters = dict(model_reporters)
+        self.model_vars = {name: [] for name in self.model_reporters}
+
+    def collect(self, model):
+        for name, reporter in self.model_reporters.items():
+            self.model_vars[name].append(reporter(model))
+
+    def get_model_vars_dataframe(self):
+        import pandas as pd
+
+        return pd.DataFrame(self.model_vars)
+
+
+class TrajectoryRecorder:
+    """
+    Streams vehicle positions to disk in fixed-size chunks.
+
+    A recording is a directory holding one file per column for the vehicle
+    rows, one file per column for the frames (time, first row, row count)
+    and a meta.json describing both. A frame is buffered after its rows,
+    and meta.json is only rewritten between frames, so it always counts
+    whole frames that are on disk.
+    """
+    def __init__(self, path, every=1, chunk_size=65536):
+        self.path = path
+        self.every = every
+        self.chunk_size = chunk_size
+
+        self.ticks = 0
+        self.rows = 0
+        self.frames = 0
+        # Rows and frames of the frames written to disk
+        self.written_rows = 0
+        self.written_frames = 0
+
+        self.buffer = {name: np.empty(chunk_size, dtype=dtype) for name, dtype in COLUMNS.items()}
+        self.frame_buffer = {name: np.empty(chunk_size, dtype=dtype) for name, dtype in FRAME_COLUMNS.items()}
+        self.buffered = 0
+        self.buffered_frames = 0
+
+        os.makedirs(path, exist_ok=True)
+        # The index of an earlier recording in the same directory would
+        # otherwise be taken for this one's
+        for name in INDEX_FILES:
+            if os.path.exists(os.path.join(path, name)):
+                os.remove(os.path.join(path, name))
+        self.files = {name: open(os.path.join(path, name + ".bin"), "wb") for name in COLUMNS}
+        self.frame_files = {name: open(os.path.join(path, "frame_" + name + ".bin"), "wb") for name in FRAME_COLUMNS}
+        self.write_meta()
+
+    def collect(self, sim):
+        """
+        Record the current positions every `every` ticks.
+        """
+        self.ticks += 1
+        if (self.ticks - 1) % self.every != 0:
+            return
+        frame = sim.project()
+        self.append(sim.t, frame[0], frame[1], frame[2], frame[4])
+
+    def append(self, t, ids, x, y, road):
+        """
+        Record one frame made of the given columns.
+        """
+        flushed = False
+        columns = {"id": ids, "x": x, "y": y, "road": road}
+        done = 0
+        while done < len(ids):
+            if self.buffered == self.chunk_size:
+                self.flush()
+                flushed = True
+            n = min(len(ids) - done, self.chunk_size - self.buffered)
+            for name, column in columns.items():
+                self.buffer[name][self.buffered:self.buffered + n] = column[done:done + n]
+            self.buffered += n
+            done += n
+
+        if self.buffered_frames == self.chunk_size:
+            self.flush()
+            flushed = True
+        i = self.buffered_frames
+        self.frame_buffer["t"][i] = t
+        self.frame_buffer["start"][i] = self.rows
+        self.frame_buffer["count"][i] = len(ids)
+        self.buffered_frames += 1
+        self.frames += 1
+        self.rows += len(ids)
+
+        if flushed:
+            self.write_meta()
+
+    def flush(self):
+        """
+        Write the buffers to disk, leaving meta.json as it is.
+        """
+        for name, f in self.files.items():
+            self.buffer[name][:self.buffered].tofile(f)
+            f.flush()
+        for name, f in self.frame_files.items():
+            self.frame_buffer[name][:self.buffered_frames].tofile(f)
+            f.flush()
+        if self.buffered_frames:
+            last = self.buffered_frames - 1
+            self.written_rows = int(self.frame_buffer["start"][last] + self.frame_buffer["count"][last])
+        self.written_frames += self.buffered_frames
+        self.buffered = 0
+        self.buffered_frames = 0
+
+    def write_meta(self):
+        meta = {
+            "columns": {name: np.dtype(dtype).str for name, dtype in COLUMNS.items()},
+            "frame_columns": {name: np.dtype(dtype).str for name, dtype in FRAME_COLUMNS.items()},
+            "rows": self.written_rows,
+            "frames": self.written_frames,
+            "every": self.every,
+        }
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+    def close(self):
+        self.flush()
+        self.write_meta()
+        for f in list(self.files.values()) + list(self.frame_files.values()):
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TrajectoryReader:
+    """
+    Memory-mapped access to a recording made by TrajectoryRecorder.
+
+    Frames are indexed by their position in the recording. Per-vehicle
+    queries use an index sorted by vehicle id that is built on first use
+    and saved next to the recording.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+
+        rows = self.meta["rows"]
+        frames = self.meta["frames"]
+        self.columns = {
+            name: self._map(name + ".bin", dtype, rows)
+            for name, dtype in self.meta["columns"].items()
+        }
+        self.frame_columns = {
+            name: self._map("frame_" + name + ".bin", dtype, frames)
+            for name, dtype in self.meta["frame_columns"].items()
+        }
+        self.times = self.frame_columns["t"]
+        self.starts = self.frame_columns["start"]
+        self.counts = self.frame_columns["count"]
+
+        self.index_rows = None
+
+    def _map(self, name, dtype, length):
+        if length == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode="r", shape=(length,))
+
+    def __len__(self):
+        return len(self.times)
+
+    def _rows(self, rows):
+        return tuple(self.columns[name][rows] for name in ("id", "x", "y", "road"))
+
+    def frame(self, i):
+        """
+        Return the ids, x, y and road ids of every vehicle in frame i.
+        """
+        start = self.starts[i]
+        return self._rows(slice(start, start + self.counts[i]))
+
+    def frame_at(self, t):
+        """
+        Return the last frame recorded at or before time t.
+        """
+        i = max(np.searchsorted(self.times, t, side="right") - 1, 0)
+        return self.frame(i)
+
+    def build_index(self):
+        """
+        Load the per-vehicle index, building and saving it if needed.
+        """
+        paths = [os.path.join(self.path, name) for name in INDEX_FILES]
+        if all(os.path.exists(path) for path in paths):
+            rows, ids, offsets = (np.load(path, mmap_mode="r") for path in paths)
+            if len(rows) == self.meta["rows"]:
+                self.index_rows, self.index_ids, self.index_offsets = rows, ids, offsets
+                return
+
+        # A stable sort keeps the rows of each vehicle in time order
+        rows = np.argsort(self.columns["id"], kind="stable")
+        ids, offsets = np.unique(self.columns["id"][rows], return_index=True)
+        offsets = np.append(offsets, len(rows))
+        for path, array in zip(paths, (rows, ids, offsets)):
+            np.save(path, array)
+        self.index_rows, self.index_ids, self.index_offsets = rows, ids, offsets
+
+    def vehicle_ids(self):
+        if self.index_rows is None:
+            self.build_index()
+        return np.asarray(self.index_ids)
+
+    def vehicle(self, vehicle_id, start=None, end=None):
+        """
+        Return the times, x, y and road ids of one vehicle, optionally
+        limited to start <= t <= end.
+        """
+        if self.index_rows is None:
+            self.build_index()
+        i = np.searchsorted(self.index_ids, vehicle_id)
+        if i == len(self.index_ids) or self.index_ids[i] != vehicle_id:
+            rows = np.empty(0, dtype=np.int64)
+        else:
+            rows = np.asarray(self.index_rows[self.index_offsets[i]:self.index_offsets[i + 1]])
+
+        # Rows of a vehicle are in time order, so a time window is a
+        # contiguous slice of them
+        if start is not None:
+            first = np.searchsorted(self.times, start, side="left")
+            lo = self.starts[first] if first < len(self) else self.meta["rows"]
+            rows = rows[np.searchsorted(rows, lo):]
+        if end is not None:
+            last = np.searchsorted(self.times, end, side="right")
+            hi = self.starts[last] if last < len(self) else self.meta["rows"]
+            rows = rows[:np.searchsorted(rows, hi)]
+
+        t = self.times[np.searchsorted(self.starts, rows, side="right") - 1]
+        return (t,) + self._rows(rows)[1:]
@@ -1,53 +1,186 @@
-from scipy.spatial import distance
 from collections import deque
-from mesa import Agent
+from lanes import mobil, MIN_GAP
+from curve import arc_length_table
+import numpy as np
+import math
 
-class Road(Agent):
+class Road:
     """
-    A road agent.
+    A road agent. Each lane keeps its vehicles in a deque ordered from
+    the front of the road to the back.
     """
-    def __init__(self, unique_id, start, end, model):
+    # Distance between lane centres, used to draw vehicles
+    lane_width = 3.5
+
+    def __init__(self, unique_id, start, end, model, lanes=1, control=None):
         self.unique_id = unique_id
         self.start = start
         self.end = end
+        # Bezier control point of a curved road
+        self.control = control
         self.model = model
 
-        self.vehicles = deque()
+        self.lanes = [deque() for _ in range(lanes)]
 
         self.init_properties()
 
     def init_properties(self):
-        self.length = distance.euclidean(self.start, self.end)
-        self.angle_sin = (self.end[1] - self.start[1]) / self.length
-        self.angle_cos = (self.end[0] - self.start[0]) / self.length
+        self.length = math.hypot(self.end[0] - self.start[0], self.end[1] - self.start[1])
+        if self.control is not None:
+            _, s = arc_length_table(np.array([self.start], dtype=float), np.array([self.end], dtype=float), np.array([self.control], dtype=float))
+            self.length = s[0, -1]
         self.has_traffic_signal = False
 
+    @property
+    def lane_count(self):
+        return len(self.lanes)
+
+    @property
+    def vehicles(self):
+        """
+        Every vehicle on the road, lane by lane.
+        """
+        if len(self.lanes) == 1:
+            return self.lanes[0]
+        return [vehicle for lane in self.lanes for vehicle in lane]
+
+    def add(self, vehicle, lane):
+        """
+        Put a vehicle at the back of a lane.
+        """
+        vehicle.lane = lane
+        self.lanes[lane].append(vehicle)
+
+    def entry_lane(self):
+        """
+        Return the lane with the most room at the start of the road.
+        """
+        best = 0
+        room = -1
+        for i, lane in enumerate(self.lanes):
+            lane_room = lane[-1].x if len(lane) > 0 else math.inf
+            if lane_room > room:
+                best = i
+                room = lane_room
+        return best
+
+    def move_lane(self, vehicle, source, target, leader):
+        """
+        Move a vehicle from lane source to lane target, right behind
+        leader, or at the front when leader is None.
+        """
+        self.lanes[source].remove(vehicle)
+        queue = self.lanes[target]
+        queue.insert(0 if leader is None else queue.index(leader) + 1, vehicle)
+        vehicle.lane = target
+
     def set_traffic_signal(self, signal, group):
         self.has_traffic_signal = True
         self.traffic_signal = signal
         self.traffic_signal_group = group
 
-    @property
-    def traffic_signal_state(self):
-        if self.has_traffic_signal:
-            i = self.traffic_signal_group
-            return self.traffic_signal.current_cycle[i]
-        return True
-
-    def step(self, dt):
-        n = len(self.vehicles)
-
-        if n > 0:
-            self.vehicles[0].step(dt)
-            for i in range(1, n):
-                self.vehicles[i].step(dt)
-            
-            if self.traffic_signal_state:
-                self.vehicles[0].unstop()
-                for vehicle in self.vehicles:
-                    vehicle.unslow()
-            else:
-                if self.vehicles[0].x >= self.length - self.traffic_signal.slow_distance:
-                    self.vehicles[0].slow(self.traffic_signal.slow_factor * self.vehicles[0]._v_max)
-                if self.vehicles[0].x >= self.length - self.traffic_signal.stop_distance and self.vehicles[0].x <= self.length - self.traffic_signal.stop_distance / 2:
-                    self.vehicles[0].stop()
+    def next_leader(self, lane=0):
+        """
+        Return the last vehicle of the lane the lead vehicle of a lane will
+        take on the next road of its path.
+        """
+        vehicle = self.lanes[lane][0]
+        if vehicle.current_road_index + 1 < len(vehicle.path):
+            next_road = self.model.road_by_id[vehicle.path[vehicle.current_road_index + 1]]
+            next_lane = next_road.lanes[min(lane, len(next_road.lanes) - 1)]
+            if len(next_lane) > 0:
+                return next_lane[-1]
+        return None
+
+    def drive(self, dt):
+        for lane, vehicles in enumerate(self.lanes):
+            n = len(vehicles)
+
+            if n > 0:
+                vehicles[0].step(dt, self.next_leader(lane), self.length)
+                for i in range(1, n):
+                    vehicles[i].step(dt, vehicles[i-1])
+
+    def constrained(self, horizon, braking, interaction):
+        """
+        Return whether a vehicle of the road needs small time steps over
+        the next horizon seconds, being held or slowed by a signal, braking
+        harder than braking, following with an IDM interaction term above
+        interaction or able to get within the signal lookahead of the end
+        of the road, and (vehicle, distance) for the vehicles that can get
+        past the end.
+        """
+        lookahead = self.model.signals.road_slow_distance[self.index]
+        busy = False
+        leaving = []
+        for lane, vehicles in enumerate(self.lanes):
+            if len(vehicles) == 0:
+                continue
+            lead = self.next_leader(lane)
+            offset = self.length
+            for vehicle in vehicles:
+                v = vehicle.v
+                reach = vehicle.x + v*horizon + vehicle.a_max*horizon*horizon/2
+                if reach - self.length >= 0:
+                    leaving.append((vehicle, reach - self.length))
+                alpha = 0
+                if lead is not None:
+                    delta_x = max(lead.x + offset - vehicle.x - lead.l, MIN_GAP)
+                    alpha = (vehicle.s0 + max(0, vehicle.T*v + (v - lead.v)*v/vehicle.sqrt_ab)) / delta_x
+                if (vehicle.stopped or vehicle.v_max < vehicle._v_max or vehicle.a < -braking or alpha > interaction
+                        or reach + lookahead >= self.length):
+                    busy = True
+                lead = vehicle
+                offset = 0
+        return busy, leaving
+
+    def apply_signal(self):
+        for vehicles in self.lanes:
+            if len(vehicles) > 0:
+                self.signal_step(vehicles)
+
+    def signal_step(self, vehicles):
+        if not self.has_traffic_signal or self.model.signals.road_green[self.index]:
+            vehicles[0].unstop()
+            for vehicle in vehicles:
+                vehicle.unslow()
+        else:
+            if vehicles[0].x >= self.length - self.traffic_signal.slow_distance:
+                vehicles[0].slow(self.traffic_signal.slow_factor * vehicles[0]._v_max)
+            if vehicles[0].x >= self.length - self.traffic_signal.stop_distance and vehicles[0].x <= self.length - self.traffic_signal.stop_distance / 2:
+                vehicles[0].stop()
+
+    def change_lanes(self):
+        """
+        Evaluate MOBIL lane changes for every vehicle on the road at once,
+        apply them and return how many there were.
+        """
+        if len(self.lanes) == 1:
+            return 0
+        vehicles = []
+        leader = []
+        lane = []
+        for i, queue in enumerate(self.lanes):
+            for k, vehicle in enumerate(queue):
+                leader.append(len(vehicles) - 1 if k > 0 else -1)
+                lane.append(i)
+                vehicles.append(vehicle)
+        if not vehicles:
+            return 0
+
+        fields = [
+            np.array([getattr(vehicle, name) for vehicle in vehicles], dtype=float)
+            for name in ("x", "v", "l", "v_max", "a_max", "s0", "T", "sqrt_ab")
+        ]
+        stopped = np.array([vehicle.stopped for vehicle in vehicles], dtype=bool)
+        lane = np.array(lane, dtype=np.int64)
+        model = self.model
+        changing, target, new_leader, _ = mobil(
+            np.arange(len(vehicles)), *fields, stopped, lane,
+            np.zeros(len(vehicles), dtype=np.int64), np.full(len(vehicles), len(self.lanes) - 1),
+            np.array(leader, dtype=np.int64),
+            model.lane_change_politeness, model.lane_change_threshold, model.lane_change_safe_deceleration,
+        )
+        for i, lane_to, lead in zip(changing.tolist(), target.tolist(), new_leader.tolist()):
+            self.move_lane(vehicles[i], int(lane[i]), lane_to, vehicles[lead] if lead >= 0 else None)
+        return len(changing)
@@ -0,0 +1,299 @@
+import numpy as np
+import random
+import heapq
+import math
+
+
+class RouteOracle:
+    """
+    Weighted shortest paths over a road network. Dijkstra runs once per
+    source road, keeping only the road each road is reached from; a path
+    is read back from it the first time it is asked for and memoized as
+    a tuple of road ids shared by every vehicle that takes it.
+
+    The search runs on the CSR arrays of the Network and visits roads in
+    the same order as networkx's Dijkstra, so ties between equally short
+    paths are broken the same way.
+    """
+    def __init__(self, network):
+        self.road_ids = network.road_ids.tolist()
+        self.index = network.index
+        self.successors = network.successors.tolist()
+        self.successor_offsets = network.successor_offsets.tolist()
+        self.length = network.length.tolist()
+        # Source index -> predecessor of every road, -1 when unreachable
+        self.trees = {}
+        self.paths = {}
+
+    def tree(self, source):
+        if source not in self.trees:
+            self.trees[source] = self.search(source)
+        return self.trees[source]
+
+    def search(self, source):
+        successors = self.successors
+        offsets = self.successor_offsets
+        length = self.length
+        # Tentative distances, and the road each road is reached from
+        seen = {source: 0}
+        previous = {source: source}
+        settled = set()
+        heap = [(0, 0, source)]
+        count = 1
+        while heap:
+            d, _, v = heapq.heappop(heap)
+            if v in settled:
+                continue
+            settled.add(v)
+            candidate = d + length[v]
+            for k in range(offsets[v], offsets[v + 1]):
+                u = successors[k]
+                if u in settled:
+                    continue
+                if u not in seen or candidate < seen[u]:
+                    seen[u] = candidate
+                    previous[u] = v
+                    heapq.heappush(heap, (candidate, count, u))
+                    count += 1
+        tree = np.full(len(length), -1, dtype=np.int32)
+        tree[list(previous)] = list(previous.values())
+        return tree
+
+    def route(self, source, target):
+        """
+        Return the shortest path from source to target, or None when target
+        can't be reached.
+        """
+        key = (source, target)
+        path = self.paths.get(key)
+        if path is None:
+            i = self.index[source]
+            j = self.index[target]
+            tree = self.tree(i)
+            if tree[j] < 0:
+                return None
+            roads = [j]
+            while roads[-1] != i:
+                roads.append(int(tree[roads[-1]]))
+            road_ids = self.road_ids
+            path = self.paths[key] = tuple(road_ids[k] for k in reversed(roads))
+        return path
+
+    def sample(self, rng=random):
+        """
+        Return the path of a random reachable origin/destination pair.
+        Unreachable pairs are drawn again, so every reachable pair is
+        equally likely without listing them.
+        """
+        n = len(self.road_ids)
+        while True:
+            path = self.route(self.road_ids[rng.randrange(n)], self.road_ids[rng.randrange(n)])
+            if path is not None:
+                return path
+
+
+class Rerouter:
+    """
+    Congestion-aware rerouting.
+
+    Every sample_interval seconds the mean speed of the vehicles on each
+    road is folded into an exponentially smoothed speed, empty roads
+    drifting back to free_speed, and the live travel time of a road is
+    its length over that speed. Every interval seconds each vehicle with
+    a choice left re-plans the rest of its path from its current road and
+    takes the new route when it is faster by more than threshold.
+
+    Routes come from one shortest-path tree per destination, shared by
+    every vehicle heading there. When travel times change, a tree is
+    checked against every edge in one vectorized pass and only searched
+    again when one of its paths may have become more than threshold
+    longer than the shortest; otherwise its distances are updated in
+    place.
+    """
+    def __init__(self, config={}):
+        self.set_default_config()
+
+        for attr, value in config.items():
+            setattr(self, attr, value)
+
+    def set_default_config(self):
+        self.interval = 60
+        self.sample_interval = 5
+        self.smoothing = 0.3
+        # Relative gain needed to change route or to search a tree again
+        self.threshold = 0.1
+        # Free-flow speed, the default vehicle speed when None
+        self.free_speed = None
+        # Floor of the smoothed speed, so that a jammed road costs a lot
+        # without costing infinitely much
+        self.min_speed = 0.5
+
+        self.trees = {}
+        self.searches = 0
+        self.reused = 0
+        self.rerouted = 0
+
+    def attach(self, sim):
+        """
+        Build the reverse adjacency of the network and start every road at
+        its free-flow travel time.
+        """
+        from vehicle import Vehicle
+
+        network = sim.network
+        if self.free_speed is None:
+            self.free_speed = Vehicle(None, sim).v_max
+        self.index = network.index
+        self.road_ids = network.road_ids.tolist()
+        self.length = network.length
+        self.speed = np.full(len(network), float(self.free_speed))
+        self.weights = self.length / self.speed
+
+        # Predecessors in CSR form, to search from the destination back
+        edges = network.edges[np.argsort(network.edges[:, 1], kind="stable")]
+        self.edges = network.edges
+        self.predecessors = edges[:, 0].tolist()
+        counts = np.bincount(edges[:, 1], minlength=len(network))
+        self.predecessor_offsets = np.concatenate(([0], np.cumsum(counts))).tolist()
+
+        self.next_sample = sim.t + self.sample_interval
+        self.next_reroute = sim.t + self.interval
+
+    def step(self, sim):
+        if sim.t >= self.next_sample:
+            self.sample(sim)
+            self.next_sample += self.sample_interval
+        if sim.t >= self.next_reroute:
+            self.reroute(sim)
+            self.next_reroute += self.interval
+
+    def sample(self, sim):
+        """
+        Fold the current mean speed of every road into the smoothed speeds.
+        """
+        n = len(self.speed)
+        engine = sim.engine
+        if engine is not None:
+            active = engine.active[:engine.size]
+            road = engine.road[:engine.size][active]
+            total = np.bincount(road, weights=engine.v[:engine.size][active], minlength=n)
+            count = np.bincount(road, minlength=n)
+        else:
+            total = np.zeros(n)
+            count = np.zeros(n, dtype=np.int64)
+            for road in sim.roads:
+                for queue in road.lanes:
+                    count[road.index] += len(queue)
+                    total[road.index] += sum(vehicle.v for vehicle in queue)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            current = np.where(count > 0, total / count, self.free_speed)
+        self.speed += self.smoothing * (current - self.speed)
+        self.weights = self.length / np.maximum(self.speed, self.min_speed)
+
+    def reroute(self, sim):
+        """
+        Re-plan the rest of the path of every vehicle with a choice left.
+        """
+        weights = self.weights
+        costs = weights.tolist()
+        index = self.index
+        by_target = {}
+        for vehicle in sim.schedule.agents:
+            path = vehicle.path
+            i = vehicle.current_road_index
+            if len(path) - i > 2:
+                by_target.setdefault(path[-1], []).append(vehicle)
+        for target, vehicles in by_target.items():
+            dist, next_road, paths = self.tree(index[target], weights)
+            for vehicle in vehicles:
+                path = vehicle.path
+                i = vehicle.current_road_index
+                current = index[path[i]]
+                best = next_road[current]
+                if best == index[path[i + 1]]:
+                    continue
+                old = sum(costs[index[road_id]] for road_id in path[i + 1:-1])
+                if dist[current] - costs[current] < old * (1 - self.threshold):
+                    sim.reroute(vehicle, tuple(path[:i + 1]) + self.route(best, paths, next_road))
+                    self.rerouted += 1
+
+    def tree(self, target, weights):
+        """
+        Return the distance to target and the next road towards it from
+        every road, and the cache of the paths read from the tree.
+        """
+        tree = self.trees.get(target)
+        if tree is not None:
+            dist = self.still_shortest(target, tree[1], weights)
+            if dist is not None:
+                self.reused += 1
+                tree = self.trees[target] = (dist.tolist(), tree[1], tree[2])
+                return tree
+        self.searches += 1
+        tree = self.trees[target] = self.search(target, weights.tolist()) + ({},)
+        return tree
+
+    def search(self, target, weights):
+        """
+        Dijkstra from target over the reversed network, a road costing its
+        travel time when it is left.
+        """
+        n = len(weights)
+        dist = [math.inf] * n
+        next_road = [-1] * n
+        dist[target] = 0
+        next_road[target] = target
+        predecessors = self.predecessors
+        offsets = self.predecessor_offsets
+        heap = [(0, target)]
+        while heap:
+            d, v = heapq.heappop(heap)
+            if d > dist[v]:
+                continue
+            for k in range(offsets[v], offsets[v + 1]):
+                u = predecessors[k]
+                candidate = d + weights[u]
+                if candidate < dist[u]:
+                    dist[u] = candidate
+                    next_road[u] = v
+                    heapq.heappush(heap, (candidate, u))
+        return dist, next_road
+
+    def still_shortest(self, target, next_road, weights):
+        """
+        Return the distances along a tree under new weights, or None when
+        an edge shows that a tree path may be more than threshold longer
+        than the shortest one.
+        """
+        next_road = np.asarray(next_road)
+        reachable = next_road >= 0
+        pointer = np.where(reachable, next_road, np.arange(len(next_road)))
+        dist = np.where(reachable, weights, 0.0)
+        dist[target] = 0
+        # Sum the weights up to the root by pointer doubling
+        while True:
+            jump = pointer[pointer]
+            dist = dist + dist[pointer]
+            if np.array_equal(jump, pointer):
+                break
+            pointer = jump
+        # Summed along the shortest path of a road, these bounds keep its
+        # tree path within 1 + threshold of it
+        a, b = self.edges[:, 0], self.edges[:, 1]
+        both = reachable[a] & reachable[b]
+        if np.any(dist[a[both]] > (1 + self.threshold) * weights[a[both]] + dist[b[both]]):
+            return None
+        return dist
+
+    def route(self, road, paths, next_road):
+        """
+        Return the road ids from road to the root of a tree, memoized so
+        that vehicles share the tuple.
+        """
+        path = paths.get(road)
+        if path is None:
+            roads = [road]
+            while next_road[roads[-1]] != roads[-1]:
+                roads.append(next_road[roads[-1]])
+            path = paths[road] = tuple(self.road_ids[i] for i in roads)
+        return path
@@ -1,7 +1,9 @@
 from simulation import Simulation
+from recorder import TrajectoryRecorder, TrajectoryReader
 import matplotlib.pyplot as plt
+import json
 
-sim = Simulation()
+sim = Simulation({"recorder": TrajectoryRecorder("recording")})
 
 sim.generate_model(
     num_vehicles=1
@@ -10,29 +12,20 @@ sim.generate_model(
 for i in range(5000):
     sim.step()
     # print(sim.vehicle_path())
+sim.recorder.close()
 
 # plot route
-sim.datacollector.collect(sim)
-data = sim.datacollector.get_model_vars_dataframe()
-sorted(data, key=lambda x: x[2])
-print(data)
-data.to_json("data.json")
-x = []
-y = []
+reader = TrajectoryReader("recording")
 
-for j in range(2):
-    x_i = []
-    y_i = []
-    for i in range(len(data)):
-        try:
-            x_i.append(data.iloc[i]["data"][j][1])
-            y_i.append(data.iloc[i]["data"][j][2])
-        except:
-            pass
-    x.append(x_i)
-    y.append(y_i)
+# Same layout the frontend reads: one [id, x, y] list per frame
+data = {}
+for i in range(len(reader)):
+    ids, x, y, road = reader.frame(i)
+    data[str(i)] = [list(row) for row in zip(ids.tolist(), x.tolist(), y.tolist())]
+with open("data.json", "w") as f:
+    json.dump({"data": data}, f)
 
-# print(x)
-
-plt.scatter(x[0], y[0], s=0.5)
+for vehicle_id in reader.vehicle_ids()[:2]:
+    t, x, y, road = reader.vehicle(vehicle_id)
+    plt.scatter(x, y, s=0.5)
 plt.show()
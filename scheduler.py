@@ -0,0 +1,116 @@
+import random
+
+
+class Status:
+    """
+    An agent attribute that tells the scheduler of the agent when it
+    changes, so the scheduler can keep its per-status counts.
+    """
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return obj.__dict__.get(self.name)
+
+    def __set__(self, obj, value):
+        state = obj.__dict__
+        old = state.get(self.name)
+        state[self.name] = value
+        schedule = state.get("_schedule")
+        if schedule is not None:
+            schedule._count(old, -1)
+            schedule._count(value, 1)
+
+
+class Scheduler:
+    """
+    A schedule that activates each agent once per step, in random order.
+
+    Agents live in one list with a map from each agent to its position, so
+    adding and removing are O(1): a removed agent is swapped with the last
+    one before popping. The number of agents with each status is kept up
+    to date as agents come and go, so get_num_agents_by_status is O(1).
+    Agents change status through set_status, or by declaring
+    `status = Status()` on their class and assigning it.
+
+    The activation order is shuffled with the random generator of the
+    model, in a buffer kept from step to step. Agents added during a step
+    are activated from the next one and agents removed during a step are
+    skipped.
+    """
+    def __init__(self, model=None, seed=None):
+        self.model = model
+        self.random = model.random if model is not None else random.Random(seed)
+        self.steps = 0
+        self.time = 0
+        self._agents = []
+        self._index = {}
+        self._status_counts = {}
+        self._order = []
+
+    def add(self, agent):
+        if agent in self._index:
+            raise ValueError("agent %r is already scheduled" % (agent.unique_id,))
+        self._index[agent] = len(self._agents)
+        self._agents.append(agent)
+        self._count(getattr(agent, "status", None), 1)
+        if isinstance(getattr(type(agent), "status", None), Status):
+            agent.__dict__["_schedule"] = self
+
+    def remove(self, agent):
+        i = self._index.pop(agent)
+        last = self._agents.pop()
+        if last is not agent:
+            self._agents[i] = last
+            self._index[last] = i
+        self._count(getattr(agent, "status", None), -1)
+        if agent.__dict__.get("_schedule") is self:
+            del agent.__dict__["_schedule"]
+
+    def set_status(self, agent, status):
+        """
+        Change the status of an agent, keeping the counts of a scheduled
+        agent up to date.
+        """
+        if isinstance(getattr(type(agent), "status", None), Status):
+            agent.status = status
+            return
+        if agent in self._index:
+            self._count(getattr(agent, "status", None), -1)
+            self._count(status, 1)
+        agent.status = status
+
+    def _count(self, status, change):
+        counts = self._status_counts
+        counts[status] = counts.get(status, 0) + change
+
+    def step(self):
+        order = self._order
+        order[:] = self._agents
+        self.random.shuffle(order)
+        index = self._index
+        for agent in order:
+            if agent in index:
+                agent.step()
+        self.steps += 1
+        self.time += 1
+
+    def get_agent_count(self):
+        return len(self._agents)
+
+    get_num_agents = get_agent_count
+
+    def get_num_agents_by_status(self, status):
+        return self._status_counts.get(status, 0)
+
+    def __contains__(self, agent):
+        return agent in self._index
+
+    def __len__(self):
+        return len(self._agents)
+
+    @property
+    def agents(self):
+        return list(self._agents)
@@ -0,0 +1,406 @@
+import numpy as np
+import argparse
+import asyncio
+import hashlib
+import base64
+import socket
+import struct
+import math
+
+# Raw TCP clients open the connection with this, WebSocket clients with
+# an HTTP upgrade request
+MAGIC = b"MUS1"
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+HELLO = 2
+KEY = 0
+DELTA = 1
+
+HEADER = struct.Struct("<BIdI")
+HELLO_HEADER = struct.Struct("<Bdd")
+DELTA_COUNTS = struct.Struct("<III")
+
+HEADING_STEPS = 65536
+
+
+def quantize(frame, resolution):
+    """
+    Turn a Simulation.project() frame into id-sorted integer columns:
+    positions in units of resolution metres, headings in 1/65536 turns.
+    """
+    order = np.argsort(frame[0], kind="stable")
+    ids = frame[0, order].astype(np.int32)
+    x = np.rint(frame[1, order] / resolution).astype(np.int32)
+    y = np.rint(frame[2, order] / resolution).astype(np.int32)
+    heading = (np.rint(frame[3, order] * (HEADING_STEPS / (2 * math.pi))).astype(np.int64) % HEADING_STEPS).astype(np.uint16)
+    return ids, x, y, heading
+
+
+def encode_key(tick, t, state):
+    """
+    Encode every vehicle of a quantized state.
+    """
+    ids, x, y, heading = state
+    return b"".join((HEADER.pack(KEY, tick, t, len(ids)), ids.tobytes(), x.tobytes(), y.tobytes(), heading.tobytes()))
+
+
+def encode_delta(tick, t, previous, state):
+    """
+    Encode a quantized state against the previous one: removed ids, added
+    vehicles in full and 16-bit moves for the rest, in id order. Returns
+    None when a move doesn't fit in 16 bits.
+    """
+    ids, x, y, heading = state
+    old_ids, old_x, old_y, _ = previous
+    kept_old = np.isin(old_ids, ids, assume_unique=True)
+    kept = np.isin(ids, old_ids, assume_unique=True)
+    removed = old_ids[~kept_old]
+    added = ~kept
+
+    dx = x[kept].astype(np.int64) - old_x[kept_old]
+    dy = y[kept].astype(np.int64) - old_y[kept_old]
+    if len(dx) and max(np.abs(dx).max(), np.abs(dy).max()) > 32767:
+        return None
+
+    return b"".join((
+        HEADER.pack(DELTA, tick, t, len(ids)),
+        DELTA_COUNTS.pack(len(removed), np.count_nonzero(added), len(dx)),
+        removed.tobytes(),
+        ids[added].tobytes(), x[added].tobytes(), y[added].tobytes(), heading[added].tobytes(),
+        dx.astype(np.int16).tobytes(), dy.astype(np.int16).tobytes(), heading[kept].tobytes(),
+    ))
+
+
+class FrameDecoder:
+    """
+    Client side of the frame format: rebuilds the vehicles from a stream
+    of hello, key and delta messages.
+    """
+    def __init__(self):
+        self.resolution = 1
+        self.fps = 0
+        self.tick = None
+        self.t = 0
+        self.ids = np.zeros(0, dtype=np.int32)
+        self.x = np.zeros(0, dtype=np.int32)
+        self.y = np.zeros(0, dtype=np.int32)
+        self.heading = np.zeros(0, dtype=np.uint16)
+
+    def decode(self, message):
+        """
+        Apply one message. Returns True when it carried a frame.
+        """
+        if message[0] == HELLO:
+            _, self.resolution, self.fps = HELLO_HEADER.unpack_from(message)
+            return False
+
+        kind, self.tick, self.t, n = HEADER.unpack_from(message)
+        offset = HEADER.size
+        if kind == KEY:
+            self.ids, offset = read(message, offset, np.int32, n)
+            self.x, offset = read(message, offset, np.int32, n)
+            self.y, offset = read(message, offset, np.int32, n)
+            self.heading, offset = read(message, offset, np.uint16, n)
+            return True
+
+        removed, added, moved = DELTA_COUNTS.unpack_from(message, offset)
+        offset += DELTA_COUNTS.size
+        removed_ids, offset = read(message, offset, np.int32, removed)
+        added_ids, offset = read(message, offset, np.int32, added)
+        added_x, offset = read(message, offset, np.int32, added)
+        added_y, offset = read(message, offset, np.int32, added)
+        added_heading, offset = read(message, offset, np.uint16, added)
+        dx, offset = read(message, offset, np.int16, moved)
+        dy, offset = read(message, offset, np.int16, moved)
+        moved_heading, offset = read(message, offset, np.uint16, moved)
+
+        kept = ~np.isin(self.ids, removed_ids, assume_unique=True)
+        ids = np.concatenate((self.ids[kept], added_ids))
+        x = np.concatenate((self.x[kept] + dx, added_x))
+        y = np.concatenate((self.y[kept] + dy, added_y))
+        heading = np.concatenate((moved_heading, added_heading))
+        order = np.argsort(ids, kind="stable")
+        self.ids, self.x, self.y, self.heading = ids[order], x[order], y[order], heading[order]
+        return True
+
+    def frame(self):
+        """
+        Return the ids, world positions and headings of the last frame.
+        """
+        return (
+            self.ids,
+            self.x * self.resolution,
+            self.y * self.resolution,
+            self.heading * (2 * math.pi / HEADING_STEPS),
+        )
+
+
+def read(message, offset, dtype, count):
+    array = np.frombuffer(message, dtype=dtype, count=count, offset=offset)
+    return array, offset + array.nbytes
+
+
+class Client:
+    def __init__(self, writer, websocket):
+        self.writer = writer
+        self.websocket = websocket
+        self.last_tick = None
+        self.sent = 0
+        self.dropped = 0
+        self.ready = asyncio.Event()
+
+    def send(self, message):
+        if self.websocket:
+            self.writer.write(websocket_header(len(message)) + message)
+        else:
+            self.writer.write(struct.pack("<I", len(message)) + message)
+
+
+class StreamServer:
+    """
+    Steps a Simulation in real time and streams vehicle frames to every
+    connected client over raw TCP or WebSocket.
+
+    Each client only ever holds the newest frame. A client whose socket
+    isn't drained when a new frame is ready skips the frames in between and
+    gets a key frame next, so slow clients never hold the simulation back.
+    """
+    def __init__(self, sim, config={}):
+        self.sim = sim
+        self.set_default_config()
+
+        for attr, value in config.items():
+            setattr(self, attr, value)
+
+        self.clients = set()
+        self.tick = -1
+        self.state = None
+        self.previous = None
+        self.messages = {}
+
+    def set_default_config(self):
+        self.host = "127.0.0.1"
+        self.port = 8765
+        self.fps = 30
+        # Metres per position unit on the wire
+        self.resolution = 0.1
+        # Bytes queued per client, in the kernel and in asyncio each,
+        # before its frames start being dropped
+        self.send_buffer = 65536
+
+    async def serve(self, frames=None):
+        """
+        Accept clients and run the simulation, forever or for `frames`
+        frames.
+        """
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        async with server:
+            try:
+                await self.run(frames)
+            finally:
+                for client in list(self.clients):
+                    client.writer.close()
+                    client.ready.set()
+
+    async def run(self, frames=None):
+        """
+        Advance the simulation by speed_multiplier simulated seconds per
+        real second and publish a frame fps times a second. When stepping
+        falls behind, the schedule restarts instead of catching up.
+        """
+        loop = asyncio.get_running_loop()
+        period = 1 / self.fps
+        deadline = loop.time()
+        published = 0
+        # Simulated time owed, stepped in whole ticks
+        owed = 0
+        while frames is None or published < frames:
+            owed += period * self.sim.speed_multiplier
+            while owed >= self.sim.dt:
+                # An adaptive step covers several ticks
+                t = self.sim.t
+                self.sim.step()
+                owed -= self.sim.t - t
+            self.publish()
+            published += 1
+
+            deadline += period
+            delay = deadline - loop.time()
+            if delay < 0:
+                deadline = loop.time()
+                delay = 0
+            await asyncio.sleep(delay)
+
+    def publish(self):
+        self.tick += 1
+        self.previous = self.state
+        self.state = quantize(self.sim.project(), self.resolution)
+        self.messages = {}
+        for client in self.clients:
+            client.ready.set()
+
+    def message(self, last_tick):
+        """
+        Return the encoded newest frame for a client that last received
+        frame last_tick, encoding each kind at most once per frame.
+        """
+        kind = DELTA if last_tick == self.tick - 1 and self.previous is not None else KEY
+        if kind not in self.messages:
+            message = None
+            if kind == DELTA:
+                message = encode_delta(self.tick, self.sim.t, self.previous, self.state)
+            if message is None:
+                message = encode_key(self.tick, self.sim.t, self.state)
+            self.messages[kind] = message
+        return self.messages[kind]
+
+    async def handle(self, reader, writer):
+        try:
+            opening = await reader.readexactly(4)
+            if opening == MAGIC:
+                client = Client(writer, websocket=False)
+            elif opening == b"GET ":
+                await accept_websocket(reader, writer)
+                client = Client(writer, websocket=True)
+            else:
+                writer.close()
+                return
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            writer.close()
+            return
+
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+        writer.transport.set_write_buffer_limits(high=self.send_buffer)
+
+        client.send(HELLO_HEADER.pack(HELLO, self.resolution, self.fps))
+        self.clients.add(client)
+        if self.state is not None:
+            client.ready.set()
+        listener = asyncio.ensure_future(self.listen(reader, client))
+        try:
+            while True:
+                await client.ready.wait()
+                client.ready.clear()
+                if listener.done() or client.writer.is_closing():
+                    break
+                tick = self.tick
+                if client.last_tick is not None:
+                    client.dropped += tick - client.last_tick - 1
+                client.send(self.message(client.last_tick))
+                client.last_tick = tick
+                client.sent += 1
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(client)
+            listener.cancel()
+            writer.close()
+
+    async def listen(self, reader, client):
+        """
+        Read from a client until it disconnects, answering WebSocket pings.
+        """
+        try:
+            while True:
+                if not client.websocket:
+                    if not await reader.read(4096):
+                        break
+                    continue
+                opcode, payload = await read_websocket_frame(reader)
+                if opcode == 0x8:
+                    break
+                if opcode == 0x9:
+                    client.writer.write(websocket_header(len(payload), opcode=0xA) + payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        client.ready.set()
+
+
+async def accept_websocket(reader, writer):
+    """
+    Finish reading a WebSocket upgrade request whose first 4 bytes were
+    already read and send the handshake response.
+    """
+    request = await reader.readuntil(b"\r\n\r\n")
+    key = None
+    for line in request.split(b"\r\n"):
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"sec-websocket-key":
+            key = value.strip()
+    if key is None:
+        raise ValueError("not a WebSocket upgrade request")
+    accept = base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest())
+    writer.write(
+        b"HTTP/1.1 101 Switching Protocols\r\n"
+        b"Upgrade: websocket\r\n"
+        b"Connection: Upgrade\r\n"
+        b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n"
+    )
+
+
+def websocket_header(length, opcode=0x2):
+    if length < 126:
+        return struct.pack("!BB", 0x80 | opcode, length)
+    if length < 65536:
+        return struct.pack("!BBH", 0x80 | opcode, 126, length)
+    return struct.pack("!BBQ", 0x80 | opcode, 127, length)
+
+
+async def read_websocket_frame(reader):
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        length, = struct.unpack("!H", await reader.readexactly(2))
+    elif length == 127:
+        length, = struct.unpack("!Q", await reader.readexactly(8))
+    mask = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask is not None:
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return first & 0x0F, payload
+
+
+async def receive(host, port):
+    """
+    Connect as a raw TCP client and yield a FrameDecoder after every
+    frame received.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(MAGIC)
+    decoder = FrameDecoder()
+    try:
+        while True:
+            length, = struct.unpack("<I", await reader.readexactly(4))
+            if decoder.decode(await reader.readexactly(length)):
+                yield decoder
+    except asyncio.IncompleteReadError:
+        pass
+    finally:
+        writer.close()
+
+
+def main():
+    from simulation import Simulation
+
+    parser = argparse.ArgumentParser(description="Run a Simulation in real time and stream it to clients.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--vehicles", type=int, default=100)
+    parser.add_argument("--speed", type=float, default=1, help="simulated seconds per real second")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    sim = Simulation({"seed": args.seed, "vectorized": True, "collect_data": False, "speed_multiplier": args.speed})
+    sim.generate_model(num_vehicles=args.vehicles)
+    server = StreamServer(sim, {"host": args.host, "port": args.port, "fps": args.fps})
+    print("streaming on %s:%d" % (args.host, args.port))
+    asyncio.run(server.serve())
+
+
+if __name__ == "__main__":
+    main()
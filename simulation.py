@@ -1,153 +1,194 @@
 from road import Road
 from vehicle import Vehicle
-from traffic_signal import TrafficSignal
-from copy import deepcopy
-from mesa import Model
-from mesa.time import RandomActivation
-from mesa.datacollection import DataCollector
+from traffic_signal import TrafficSignal, SignalController
+from engine import VehicleEngine
+from routing import RouteOracle
+from scheduler import Scheduler
+from network import Network, load_network, DEFAULT_NETWORK
+from recorder import DataCollector
 import math
 import random
-import networkx as nx
+import numpy as np
 
-class Simulation(Model):
+class Simulation:
     """A model with some number of agents."""
     def __init__(self, config={}):
         self.set_default_config()
 
         for attr, value in config.items():
             setattr(self, attr, value)
-        self.schedule = RandomActivation(self)
+        # Per-simulation generator, so replicas don't share global state
+        self.random = random.Random(self.seed)
+        self.schedule = Scheduler(self)
 
         self.datacollector = DataCollector(
             model_reporters={"data": lambda m: m.vehicle_path()}
         )
 
-        self.G = nx.DiGraph()
-        self.G_inverse = nx.DiGraph()
-        
+        self._graph = None
+
+    @property
+    def G(self):
+        """
+        The road network as a networkx DiGraph, built on first use so that
+        networkx is only imported by code that needs it.
+        """
+        if self._graph is None:
+            self._graph = self.network.graph()
+        return self._graph
 
     def set_default_config(self):
         self.t = 0
         self.dt = 1/60
         self.speed_multiplier = 1
+        # Adaptive integration: each step() covers about max_dt seconds,
+        # only constrained roads being sub-stepped every dt. None keeps a
+        # single dt step for every vehicle.
+        self.max_dt = None
+        # Deceleration and IDM interaction term above which a vehicle is
+        # constrained
+        self.substep_braking = 0.5
+        self.substep_interaction = 0.5
+        self.seed = None
+        # Path of a network file, or a compiled Network
+        self.network = DEFAULT_NETWORK
         self.roads = []
+        self.road_by_id = {}
         self.traffic_lights = []
+        self.traffic_signals = True
+        # Settings of the signals put at every merge, as in the config of
+        # a TrafficSignal, e.g. {"mode": "actuated", "min_green": 5}
+        self.signal_config = {}
+        self.signals = None
+        # Keep vehicle state in NumPy arrays and step it in one batch
+        self.vectorized = False
+        # Threads stepping the engine, one region of roads per worker
+        # unless regions says otherwise. Regions are only stepped apart
+        # while they hold min_region_vehicles on average; see VehicleEngine
+        self.workers = 1
+        self.regions = None
+        self.min_region_vehicles = 10000
+        # MOBIL lane changing on multi-lane roads
+        self.lane_change_politeness = 0.2
+        self.lane_change_threshold = 0.1
+        self.lane_change_safe_deceleration = 4
+        self.multi_lane_roads = []
+        self.engine = None
+        # Stream positions to disk instead of collecting them in memory
+        self.recorder = None
+        # Buffer behind project(), with scratch columns for the engine's
+        # ids, road indices, lanes, positions and lateral offsets
+        self.projection = np.empty((5, 0))
+        self.projection_ids = np.empty(0, dtype=np.int64)
+        self.projection_index = np.empty((2, 0), dtype=np.int32)
+        self.projection_work = np.empty((2, 0))
+        self.collect_data = True
+        # Profiler timing every phase of step(), None to run untimed
+        self.profiler = None
+
+        # Origin/destination demand spawning vehicles while running
+        self.demand = None
+        # Rerouter re-planning paths around congestion, None to keep them
+        self.rerouter = None
+        # Running flow, occupancy, speed and trip statistics, None to skip
+        self.metrics = None
+        # Grid index answering proximity queries, None without one
+        self.spatial = None
+        self.next_vehicle_id = 0
+        # Retired vehicles waiting to be reused by spawn
+        self.free_vehicles = []
+
+        self.completed_trips = 0
+        self.total_travel_time = 0
+        # Travel time beyond driving the whole path at the desired speed
+        self.total_delay = 0
 
     def generate_roads(self):
         """
-        Generate a road with a given number of lanes.
-        """
-
-        self.roads.append(Road(1, (-247.3,-78.7), (5.1,-78.7), self))
-        self.roads.append(Road(2, (5.1,-78.7), (48.3,-98.7), self))
-        self.roads.append(Road(3, (48.3,-98.7), (141.86,-98.7), self))
-        self.roads.append(Road(4, (141.86,-98.7), (178.98,-134.7), self))
-        self.roads.append(Road(5, (178.98,-134.7), (178.98,-241), self))
-        self.roads.append(Road(6, (178.98,-241), (178.98,-342.6), self))
-        self.roads.append(Road(7, (178.98,-342.6), (143.1,-378.6), self))
-        self.roads.append(Road(8, (143.1,-378.6), (-256.5,-378.6), self))
-        self.roads.append(Road(9, (-256.5,-378.6), (-283.8,-408.6), self))
-        self.roads.append(Road(10, (-256.5,-378.6), (-283.8,-351.2), self))
-        self.roads.append(Road(11, (-283.8,-351.2), (-283.8,-408.6), self))
-        self.roads.append(Road(12, (-283.8,-408.6), (-319.5,-446.3), self))
-        self.roads.append(Road(13, (-319.5,-446.3), (-356.4,-410.8), self))
-        self.roads.append(Road(14, (-356.4,-410.8), (-356.4,-377.9), self))
-        self.roads.append(Road(15, (-356.4,-377.9), (-319.7,-341.5), self))
-        self.roads.append(Road(16, (-319.7,-341.5), (-246.4,-341.5), self))
-        self.roads.append(Road(17, (-246.4,-341.5), (-190.5,-341.5), self))
-        self.roads.append(Road(18, (-190.5,-341.5), (53.6,-341.5), self))
-        self.roads.append(Road(19, (53.6,-341.5), (89.2,-303.4), self))
-        self.roads.append(Road(20, (89.2,-303.4), (89.2,-241.1), self))
-        self.roads.append(Road(21, (89.2,-241.1), (89.2,-176.8), self))
-        self.roads.append(Road(22, (89.2,-176.8), (52.39,-141.2), self))
-        self.roads.append(Road(23, (52.39,-141.2), (-283.8,-141.2), self))
-        self.roads.append(Road(24, (-283.8,-351.2), (-283.8,-141.2), self))
-        self.roads.append(Road(25, (-283.8,-141.2), (-283.8,-115), self))
-        self.roads.append(Road(26, (-283.8,-115), (-247.3,-78.7), self))
-        self.roads.append(Road(27, (178.98,-241), (89.2,-241), self))
-        self.roads.append(Road(28, (89.2,-241), (-180.1,-241), self))
-        self.roads.append(Road(29, (-180.1,-241), (-218.5,-277.7), self))
-        self.roads.append(Road(30, (-218.5,-277.7), (-218.5,-312.5), self))
-        self.roads.append(Road(31, (-190.5,-341.5), (-218.5,-312.5), self))
-        self.roads.append(Road(32, (-246.4,-341.5), (-218.5,-312.5), self))
-
-        # invert the direction of the roads
-        self.roads.append(Road(101, (5.1,-78.7), (-247.3,-78.7), self))
-        self.roads.append(Road(126,  (-247.3,-78.7),(-283.8,-115), self))
-        self.roads.append(Road(125,  (-283.8,-115), (-283.8,-141.2), self))
-        self.roads.append(Road(123,  (-283.8,-141.2),(52.39,-141.2), self))
-        self.roads.append(Road(124,  (-283.8,-141.2),(-283.8,-351.2), self))
-        self.roads.append(Road(102, (48.3,-98.7), (5.1,-78.7), self))
-        self.roads.append(Road(103, (141.86,-98.7), (48.3,-98.7), self))
-        self.roads.append(Road(104, (178.98,-134.7), (141.86,-98.7), self))
-        self.roads.append(Road(105, (178.98,-241), (178.98,-134.7), self))
-        self.roads.append(Road(106, (178.98,-342.6), (178.98,-241), self))
-        self.roads.append(Road(107, (143.1,-378.6), (178.98,-342.6), self))
-        self.roads.append(Road(108, (-256.5,-378.6), (143.1,-378.6), self))
-        self.roads.append(Road(109,  (-283.8,-408.6), (-256.5,-378.6), self))
-        self.roads.append(Road(110, (-283.8,-351.2), (-256.5,-378.6), self))
-        self.roads.append(Road(111, (-283.8,-408.6), (-283.8,-351.2), self))
-        self.roads.append(Road(112, (-319.5,-446.3), (-283.8,-408.6), self))
-        self.roads.append(Road(113, (-319.5,-446.3), (-356.4,-410.8), self))
-        self.roads.append(Road(114, (-356.4,-410.8), (-356.4,-377.9), self))
-        self.roads.append(Road(115, (-356.4,-377.9), (-319.7,-341.5), self))
-        self.roads.append(Road(116, (-319.7,-341.5), (-246.4,-341.5), self))
-        self.roads.append(Road(117, (-190.5,-341.5),(-246.4,-341.5), self))
-        self.roads.append(Road(118, (53.6,-341.5),(-190.5,-341.5), self))
-        self.roads.append(Road(119,  (89.2,-303.4),(53.6,-341.5), self))
-        self.roads.append(Road(120,  (89.2,-241.1), (89.2,-303.4),self))
-        self.roads.append(Road(121,  (89.2,-176.8),(89.2,-241.1), self))
-        self.roads.append(Road(122,  (52.39,-141.2),(89.2,-176.8), self))
-        self.roads.append(Road(127,  (89.2,-241),(178.98,-241), self))
-        self.roads.append(Road(128,  (-180.1,-241),(89.2,-241), self))
-        self.roads.append(Road(129,  (-218.5,-277.7),(-180.1,-241), self))
-        self.roads.append(Road(130,  (-218.5,-312.5),(-218.5,-277.7), self))
-        self.roads.append(Road(131,  (-218.5,-312.5),(-190.5,-341.5), self))
-        self.roads.append(Road(132,  (-218.5,-312.5),(-246.4,-341.5), self))
-        
-        self.G.add_edges_from([(1, 2, {'weight': 252.4}), (2, 3, {'weight': 47.6}), (3, 4, {'weight': 93.5}), (4, 5, {'weight': 51.7}), (5, 6, {'weight': 106.3}), (5, 27, {'weight': 0}), (6, 7, {'weight': 101.6}), (7, 8, {'weight': 50.8}), (8, 9, {'weight': 399.6}), (8, 10, {'weight': 399.6}), (9, 11, {'weight': 0}), (10, 11, {'weight': 0}), (11, 24, {'weight': 57.4}), (9, 12, {'weight': 40.5}), (12, 13, {'weight': 51.9}), (13, 14, {'weight': 51.2}), (14, 15, {'weight': 32.9}), (15, 16, {'weight': 50.9}), (16, 17, {'weight': 73.29}), (16, 32, {'weight': 0}), (17, 31, {'weight': 0}), (31, 30, {'weight': 40.3}), (17, 18, {'weight': 55.9}), (18, 19, {'weight': 244.1}), (19, 20, {'weight': 52.14}), (20, 27, {'weight': 62.29}), (21, 22, {'weight': 64.29}), (22, 23, {'weight': 51.2}), (23, 25, {'weight': 336.19}), (23, 24, {'weight': 0}), (10, 24, {'weight': 38.6}), (24, 25, {'weight': 210.0}), (25, 26, {'weight': 26.2}), (32, 30, {'weight': 40.24}), (30, 29, {'weight': 34.8}), (28, 27, {'weight': 269.3}), (26, 1, {'weight': 51.47}), (31, 18, {'weight': 0}), (27, 6, {'weight': 0}), (28, 21, {'weight': 0}), (20, 21, {'weight': 0})])
-
-        # invert edges
-        self.G_inverse.add_edges_from([(102, 101, {'weight': 252.4}), (103, 102, {'weight': 47.6}), (104, 103, {'weight': 93.5}), (105, 104, {'weight': 51.7}), (106, 105, {'weight': 106.3}), (127, 105, {'weight': 0}), (107, 106, {'weight': 101.6}), (108, 107, {'weight': 50.8}), (109, 108, {'weight': 399.6}), (110, 108, {'weight': 399.6}), (111, 109, {'weight': 0}), (111, 110, {'weight': 0}), (124, 111, {'weight': 57.4}), (112, 109, {'weight': 40.5}), (113, 112, {'weight': 51.9}), (114, 113, {'weight': 51.2}), (115, 114, {'weight': 32.9}), (116, 115, {'weight': 50.9}), (117, 116, {'weight': 73.29}), (132, 116, {'weight': 0}), (131, 117, {'weight': 0}), (130, 131, {'weight': 40.3}), (118, 117, {'weight': 55.9}), (119, 118, {'weight': 244.1}), (120, 119, {'weight': 52.14}), (127, 120, {'weight': 62.29}), (121, 127, {'weight': 0}), (122, 121, {'weight': 64.29}), (123, 122, {'weight': 51.2}), (125, 123, {'weight': 336.19}), (124, 123, {'weight': 0}), (124, 110, {'weight': 38.6}), (125, 124, {'weight': 210.0}), (126, 125, {'weight': 26.2}), (130, 132, {'weight': 40.24}), (129, 130, {'weight': 34.8}), (127, 128, {'weight': 269.3}), (101, 126, {'weight': 51.47}), (118, 131, {'weight': 0}), (106, 127, {'weight': 0}), (112, 111,  {'weight': 0}), (121, 128,  {'weight': 0})])
-    # def generate_traffic_signals(self, num_traffic_lights):
-    #     for i in range(num_traffic_lights):
-    #         self.traffic_lights.append(TrafficSignal(i, 0, {}, self))
+        Load the road network and build a Road for every road in it.
+        """
+        if not isinstance(self.network, Network):
+            self.network = load_network(self.network)
+        network = self.network
+
+        start = network.start.tolist()
+        end = network.end.tolist()
+        control = network.control.tolist()
+        for i, road_id in enumerate(network.road_ids.tolist()):
+            curve = None if math.isnan(control[i][0]) else tuple(control[i])
+            self.roads.append(Road(road_id, tuple(start[i]), tuple(end[i]), self, int(network.lanes[i]), curve))
+        self.geometry = network.geometry
+
+        for i, road in enumerate(self.roads):
+            road.index = i
+        self.road_by_id = {road.unique_id: road for road in self.roads}
+        self.multi_lane_roads = [road for road in self.roads if road.lane_count > 1]
+
+        self.routes = RouteOracle(network)
+
+    def generate_traffic_signals(self, config=None):
+        """
+        Put a signal at every merge. Each road leading into the merge is a
+        group with its own green phase; roads that already belong to a
+        signal are left out. Signals take config, signal_config by default.
+        """
+        if config is None:
+            config = self.signal_config
+        road_ids = self.network.road_ids.tolist()
+        predecessors = {road_id: set() for road_id in road_ids}
+        for a, b in self.network.edges.tolist():
+            predecessors[road_ids[b]].add(road_ids[a])
+        for node in sorted(predecessors):
+            approaches = [
+                self.road_by_id[road] for road in sorted(predecessors[node])
+                if not self.road_by_id[road].has_traffic_signal
+            ]
+            if len(approaches) < 2:
+                continue
+            cycle = [tuple(i == j for j in range(len(approaches))) for i in range(len(approaches))]
+            signal_config = {"cycle_length": cycle}
+            signal_config.update(config)
+            self.traffic_lights.append(TrafficSignal(node, [[road] for road in approaches], signal_config, self))
+
+    def generate_signal_controller(self):
+        self.signals = SignalController(self.traffic_lights, self.roads)
+
+    def coordinate(self, road_ids, speed=None):
+        """
+        Offset the fixed-time signals along a corridor so that a platoon
+        leaving the first signaled road on a green reaches every following
+        signal as it turns green.
+        """
+        if speed is None:
+            speed = Vehicle(None, self).v_max
+
+        first = None
+        distance = 0
+        for road_id in road_ids:
+            road = self.road_by_id[road_id]
+            if first is not None:
+                distance += road.length
+            if not road.has_traffic_signal:
+                continue
+            signal = road.traffic_signal
+            green_start = signal.green_start(road.traffic_signal_group)
+            if first is None:
+                # Time within the cycle at which the platoon leaves
+                first = green_start - signal.offset
+                continue
+            offset = (green_start - distance / speed - first) % sum(signal.phase_durations)
+            self.signals.set_offset(signal, offset)
 
     def generate_vehicle(self, num_vehicles):
         for i in range(num_vehicles):
-            path = []
-            while len(path) == 0:
-                start = random.randint(1, 32)
-                end = random.randint(1, 32)
-                print(start, end)
-                try:
-                    path1 = nx.shortest_path(self.G, start, end)
-                except:
-                    path1 = []
-                try:
-                    start = start + 100
-                    end = end + 100
-                    path2 = nx.shortest_path(self.G_inverse, start, end)
-                except:
-                    path2 = []
-                if len(path1) > 0 and len(path2) > 0:
-                    path = min(path1, path2, key=len)
-                elif len(path1) == 0 and len(path2) == 0:
-                    path = []
-                elif len(path1) == 0 and len(path2) > 0:
-                    path = path2
-                else:
-                    path = path1
-                if len(path) > 0:
-                    print(path)
-                    for j in range(len(self.roads)):
-                        if start == self.roads[j].unique_id:
-                            start_road = j
-
-                    self.roads[start_road].vehicles.append(Vehicle(i, self, {"path": path}))
+            path = self.routes.sample(self.random)
+            vehicle = Vehicle(self.next_vehicle_id, self, {"path": path, "departure_time": self.t})
+            self.next_vehicle_id += 1
+            road = self.road_by_id[path[0]]
+            road.add(vehicle, road.entry_lane())
     
     def generate_schedule(self):
-        self.schedule = RandomActivation(self)
+        self.schedule = Scheduler(self)
         # for agent in self.traffic_lights:
         #     self.schedule.add(agent)
         for road in self.roads:
@@ -156,48 +197,442 @@ class Simulation(Model):
     
     def generate_agents(self, num_vehicles):
         self.generate_roads()
+        if self.traffic_signals:
+            self.generate_traffic_signals()
+        self.generate_signal_controller()
         self.generate_vehicle(num_vehicles)
         self.generate_schedule()
 
+    def generate_engine(self):
+        self.engine = VehicleEngine(self.roads, self.signals)
+        regions = self.regions or self.workers
+        if regions > 1:
+            self.engine.partition(self.network.partition(regions), self.workers, self.min_region_vehicles)
+        for road in self.roads:
+            for vehicle in road.vehicles:
+                self.engine.add(vehicle, road)
+
     def generate_model(self, num_vehicles):
+        if not self.vectorized and (self.workers > 1 or self.regions is not None):
+            raise ValueError("workers and regions need vectorized=True")
         self.generate_agents(num_vehicles)
         self.generate_schedule()
+        if self.vectorized:
+            self.generate_engine()
+        if self.demand is not None:
+            self.demand.attach(self)
+        if self.rerouter is not None:
+            self.rerouter.attach(self)
+        if self.metrics is not None:
+            self.metrics.attach(self)
+        if self.spatial is not None:
+            self.spatial.attach(self)
 
     def vehicle_path(self):
-        vehicle_positions = []
-        for road in self.roads:
-            for car in road.vehicles:
-                x = road.start[0] + road.angle_cos * car.x
-                y = road.start[1] + road.angle_sin * car.x
-                # current_road = road.unique_id
-                vehicle_positions.append((car.unique_id, x, y))
-        return vehicle_positions
+        ids, x, y, _ = self.vehicle_columns()
+        return list(zip(ids.tolist(), x.tolist(), y.tolist()))
+
+    def vehicle_state(self):
+        """
+        Return the ids, road indices, positions along the road and lanes of
+        every vehicle as NumPy arrays.
+        """
+        if self.engine is not None:
+            engine = self.engine
+            slots = np.flatnonzero(engine.active[:engine.size])
+            return engine.vehicle_id[slots], engine.road[slots], engine.x[slots], engine.lane[slots]
+
+        ids, road, x, lane = [], [], [], []
+        for road_t in self.roads:
+            for car in road_t.vehicles:
+                ids.append(car.unique_id)
+                road.append(road_t.index)
+                x.append(car.x)
+                lane.append(car.lane)
+        return (
+            np.array(ids, dtype=np.int64),
+            np.array(road, dtype=np.int64),
+            np.array(x, dtype=float),
+            np.array(lane, dtype=np.int64),
+        )
+
+    def vehicle_columns(self):
+        """
+        Return the ids, world positions and road ids of every vehicle as
+        NumPy arrays.
+        """
+        ids, road, x, lane = self.vehicle_state()
+        # Lanes are laid out to the right of the first one
+        world_x, world_y = self.geometry.position(road, x, lane * Road.lane_width)
+        return ids, world_x, world_y, self.network.road_ids[road]
+
+    def project(self):
+        """
+        Return a (5, n) array whose rows are the id, world x, world y,
+        heading in radians and road id of every vehicle. It is a view of a
+        buffer reused on every call, so copy it to keep it past the next
+        one. With the engine, vehicles are gathered into scratch columns
+        kept next to the buffer; the indices of the active slots and of
+        the road segments are the only arrays allocated per call.
+        """
+        engine = self.engine
+        if engine is None:
+            ids, road, x, lane = self.vehicle_state()
+            n = len(ids)
+        else:
+            slots = np.flatnonzero(engine.active[:engine.size])
+            n = len(slots)
+        if self.projection.shape[1] < n:
+            size = max(n, 2 * self.projection.shape[1])
+            self.projection = np.empty((5, size))
+            self.projection_ids = np.empty(size, dtype=np.int64)
+            self.projection_index = np.empty((2, size), dtype=np.int32)
+            self.projection_work = np.empty((2, size))
+        frame = self.projection[:, :n]
+
+        if engine is None:
+            frame[0] = ids
+            self.geometry.project(road, x, lane * Road.lane_width, frame[1], frame[2], frame[3])
+            frame[4] = self.network.road_ids[road]
+            return frame
+
+        ids = self.projection_ids[:n]
+        road, lane = self.projection_index[:, :n]
+        x, side = self.projection_work[:, :n]
+        np.take(engine.vehicle_id, slots, out=ids, mode="clip")
+        frame[0] = ids
+        np.take(engine.road, slots, out=road, mode="clip")
+        np.take(engine.x, slots, out=x, mode="clip")
+        np.take(engine.lane, slots, out=lane, mode="clip")
+        # Lanes are laid out to the right of the first one
+        side[:] = lane
+        side *= Road.lane_width
+        self.geometry.project(road, x, side, frame[1], frame[2], frame[3])
+        np.take(self.network.road_ids, road, out=ids, mode="clip")
+        frame[4] = ids
+        return frame
+
+    def spawn(self, path, departure_time=None):
+        """
+        Put a vehicle at the start of the first road of path, reusing a
+        retired vehicle when there is one.
+        """
+        config = {"path": path, "departure_time": self.t if departure_time is None else departure_time}
+        if self.free_vehicles:
+            vehicle = self.free_vehicles.pop()
+            vehicle.reset(self.next_vehicle_id, config)
+        else:
+            vehicle = Vehicle(self.next_vehicle_id, self, config)
+        self.next_vehicle_id += 1
+
+        road = self.road_by_id[path[0]]
+        road.add(vehicle, road.entry_lane())
+        if self.engine is not None:
+            self.engine.add(vehicle, road)
+        if self.metrics is not None:
+            self.metrics.enter(road.index, vehicle, self.t)
+        self.schedule.add(vehicle)
+        return vehicle
+
+    def retire(self, vehicle):
+        """
+        Record the trip of a vehicle that reached the end of its path and
+        keep the vehicle for reuse.
+        """
+        travel_time = self.t - vehicle.departure_time
+        free_flow = sum(self.road_by_id[road_id].length for road_id in vehicle.path) / vehicle._v_max
+        self.completed_trips += 1
+        self.total_travel_time += travel_time
+        self.total_delay += travel_time - free_flow
+        if self.demand is not None:
+            self.demand.retired(vehicle, travel_time)
+        if self.metrics is not None:
+            self.metrics.retired(vehicle, self.t, travel_time - free_flow)
+
+        if self.engine is not None:
+            self.engine.remove(vehicle)
+        self.schedule.remove(vehicle)
+        self.free_vehicles.append(vehicle)
+
+    def transition(self, road, lane=0):
+        """
+        Move the lead vehicle of a lane onto the next road of its path,
+        keeping its lane when the next road has enough of them.
+        """
+        vehicle = road.lanes[lane].popleft()
+        if self.engine is not None:
+            self.engine.leave(road, lane)
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.leave(road.index, vehicle, self.t)
+
+        if vehicle.current_road_index + 1 < len(vehicle.path):
+            vehicle.current_road_index += 1
+            vehicle.x = 0
+            next_road = self.road_by_id[vehicle.path[vehicle.current_road_index]]
+            next_road.add(vehicle, min(lane, next_road.lane_count - 1))
+            if self.engine is not None:
+                self.engine.enter(vehicle, next_road)
+            if metrics is not None:
+                metrics.enter(next_road.index, vehicle, self.t)
+        else:
+            self.retire(vehicle)
+
+    def reroute(self, vehicle, path):
+        """
+        Give a vehicle a new path, which must keep the roads it has
+        already driven.
+        """
+        vehicle.path = path
+        if self.engine is not None:
+            self.engine.update_path(vehicle)
+
+    def change_lanes(self):
+        """
+        Apply the MOBIL lane changes of every multi-lane road and return
+        how many there were.
+        """
+        if not self.multi_lane_roads:
+            return 0
+        if self.engine is None:
+            return sum(road.change_lanes() for road in self.multi_lane_roads)
+
+        engine = self.engine
+        changes = engine.change_lanes(
+            self.lane_change_politeness, self.lane_change_threshold, self.lane_change_safe_deceleration,
+        )
+        for slot, source, target, leader in zip(*changes):
+            road = self.roads[engine.road[slot]]
+            road.move_lane(engine.vehicles[slot], source, target, engine.vehicles[leader] if leader >= 0 else None)
+        return len(changes[0])
+
+    def close(self):
+        """
+        Shut down the worker threads of the engine, if any.
+        """
+        if self.engine is not None:
+            self.engine.close()
+
+    def save(self, path):
+        """
+        Write a checkpoint of the whole simulation state to path.
+        """
+        from checkpoint import save
+        save(self, path)
+
+    @staticmethod
+    def restore(path, config={}):
+        """
+        Return a new Simulation continuing from a checkpoint written by
+        save(). config overrides the stored settings.
+        """
+        from checkpoint import restore
+        return restore(path, config)
 
     def step(self):
-        for road in self.roads:
-            road.step(self.dt)
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.start(self)
+        if self.max_dt is not None:
+            self.adaptive_step()
+        else:
+            self.signals.update(self.t, self)
+            self.end_phase("signal_control")
+            if self.demand is not None:
+                self.demand.step(self)
+            self.end_phase("demand")
+            if self.rerouter is not None:
+                self.rerouter.step(self)
+            self.end_phase("rerouting")
+            self.drive()
+            self.end_phase("motion")
+            self.apply_signals()
+            self.end_phase("signal_rules")
+            self.end_phase("lane_changes", self.change_lanes())
+            self.end_phase("transitions", self.transitions())
+            self.t += self.dt
+            self.collect()
+            self.end_phase("collection")
+        if profiler is not None:
+            profiler.finish(self)
 
-        for road in self.roads:
-            if len(road.vehicles) == 0:
-                continue
+    def end_phase(self, name, count=0):
+        """
+        Tell the profiler, if there is one, that a phase of step() ended,
+        with the number of events it counted.
+        """
+        if self.profiler is not None:
+            self.profiler.end_phase(self, name, count)
+
+    def adaptive_step(self):
+        """
+        Advance by max_dt rounded to whole dt. Roads returned by
+        substep_roads() take steps of dt, every other road a single step
+        of the whole length; signals, lane changes and transitions run as
+        in step(), lane changes once at the end.
+        """
+        substeps = max(1, round(self.max_dt / self.dt))
+        horizon = substeps * self.dt
+        self.signals.update(self.t, self)
+        self.end_phase("signal_control")
+        if self.demand is not None:
+            self.demand.step(self)
+        self.end_phase("demand")
+        if self.rerouter is not None:
+            self.rerouter.step(self)
+        self.end_phase("rerouting")
+
+        fine = self.substep_roads(horizon)
+        # Passes over every road skip the masks
+        roads = None if fine.all() else fine
+        engine = self.engine
+        if engine is None:
+            fine_roads = [self.roads[i] for i in np.flatnonzero(fine).tolist()]
+        constrained = fine.any()
+        profiler = self.profiler
+        transitions = lane_changes = stepped = 0
+        for i in range(substeps):
+            if i == 0:
+                if engine is None:
+                    for road in self.roads:
+                        road.drive(self.dt if fine[road.index] else horizon)
+                elif roads is None:
+                    engine.drive(self.dt)
+                else:
+                    engine.drive(np.where(fine[engine.road[:engine.size]], self.dt, horizon))
+                if profiler is not None:
+                    stepped += self.schedule.get_agent_count()
+                    profiler.hold_signals(self)
+                self.apply_signals()
+                if profiler is not None:
+                    profiler.count_signals(self)
+            elif constrained:
+                self.signals.update(self.t, self)
+                if engine is not None:
+                    engine.drive(self.dt, roads)
+                    if profiler is not None:
+                        stepped += self.count_on(fine)
+                        profiler.hold_signals(self)
+                    engine.apply_signals(roads)
+                else:
+                    for road in fine_roads:
+                        road.drive(self.dt)
+                    if profiler is not None:
+                        stepped += self.count_on(fine)
+                        profiler.hold_signals(self)
+                    for road in fine_roads:
+                        road.apply_signal()
+                if profiler is not None:
+                    profiler.count_signals(self)
+            if i == substeps - 1:
+                lane_changes += self.change_lanes()
+            if i == 0:
+                transitions += self.transitions()
+            elif constrained:
+                transitions += self.transitions(roads)
+            self.t += self.dt
+        self.collect()
+        if profiler is not None:
+            profiler.count("vehicles_stepped", stepped)
+            profiler.count("lane_changes", lane_changes)
+            profiler.count("transitions", transitions)
+        self.end_phase("adaptive_step")
+
+    def count_on(self, roads):
+        """
+        Return the number of vehicles on the roads selected by the roads
+        mask.
+        """
+        if self.engine is not None:
+            engine = self.engine
+            return int(np.count_nonzero(roads[engine.road[:engine.size]] & engine.active[:engine.size]))
+        return sum(len(queue) for i in np.flatnonzero(roads).tolist() for queue in self.roads[i].lanes)
 
-            vehicle = road.vehicles[0]
-
-            if vehicle.x >= road.length:
-                if vehicle.current_road_index + 1 < len(vehicle.path):
-                    vehicle.current_road_index += 1
-                    new_vehicle = deepcopy(vehicle)
-                    new_vehicle.x = 0
-                    # Add it to the next road
-                    next_road_index = vehicle.path[vehicle.current_road_index]
-                    for road_t in self.roads:
-                        if road_t.unique_id == next_road_index:
-                            road_t.vehicles.append(new_vehicle)
-                            break
-
-                # In all cases, remove it from its road
-                road.vehicles.popleft() 
-            
-        self.t += self.dt
-        self.datacollector.collect(self)
+    def substep_roads(self, horizon):
+        """
+        Return which roads need steps of dt over the next horizon seconds:
+        roads with a constrained vehicle (see Road.constrained) and the
+        roads a vehicle can drive onto before the end of the horizon.
+        """
+        fine = np.zeros(len(self.roads), dtype=bool)
+        if self.engine is not None:
+            engine = self.engine
+            busy, excess = engine.constrained(horizon, self.substep_braking, self.substep_interaction)
+            fine[engine.road[:engine.size][busy]] = True
+            slots = np.flatnonzero(excess >= 0)
+            leaving = zip([engine.vehicles[slot] for slot in slots.tolist()], excess[slots].tolist())
+        else:
+            leaving = []
+            for road in self.roads:
+                fine[road.index], vehicles = road.constrained(horizon, self.substep_braking, self.substep_interaction)
+                leaving.extend(vehicles)
+
+        for vehicle, remaining in leaving:
+            path = vehicle.path
+            i = vehicle.current_road_index
+            while remaining >= 0 and i + 1 < len(path):
+                i += 1
+                road = self.road_by_id[path[i]]
+                fine[road.index] = True
+                remaining -= road.length
+
+        # When most vehicles need dt anyway, stepping them all is cheaper
+        # than picking them out
+        if self.engine is not None:
+            engine = self.engine
+            total = np.count_nonzero(engine.active[:engine.size])
+        else:
+            total = self.schedule.get_agent_count()
+        if self.count_on(fine) > total / 2:
+            fine[:] = True
+        return fine
+
+    def drive(self):
+        """
+        Move every vehicle by one time step.
+        """
+        if self.engine is not None:
+            self.engine.drive(self.dt)
+        else:
+            for road in self.roads:
+                road.drive(self.dt)
+
+    def apply_signals(self):
+        """
+        Slow down and stop the vehicles approaching a red light, release
+        the others.
+        """
+        if self.engine is not None:
+            self.engine.apply_signals()
+        else:
+            for road in self.roads:
+                road.apply_signal()
+
+    def transitions(self, roads=None):
+        """
+        Move every vehicle past the end of its road onto the next one and
+        return how many did, only looking at the roads selected by the
+        roads mask when given.
+        """
+        count = 0
+        if self.engine is not None:
+            for road, lane in self.engine.arrivals(roads):
+                self.transition(self.roads[road], lane)
+                count += 1
+        else:
+            if roads is not None:
+                roads = [self.roads[i] for i in np.flatnonzero(roads).tolist()]
+            for road in self.roads if roads is None else roads:
+                for lane, vehicles in enumerate(road.lanes):
+                    if len(vehicles) > 0 and vehicles[0].x >= road.length:
+                        self.transition(road, lane)
+                        count += 1
+        return count
 
+    def collect(self):
+        if self.metrics is not None:
+            self.metrics.collect(self)
+        if self.recorder is not None:
+            self.recorder.collect(self)
+        elif self.collect_data:
+            self.datacollector.collect(self)
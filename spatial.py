@@ -0,0 +1,142 @@
+import numpy as np
+
+
+class SpatialIndex:
+    """
+    Uniform grid over the road segments and the vehicles of a simulation,
+    for proximity queries.
+
+    Cells are numbered row by row, so the cells of a box make one range
+    of numbers per row. Road segments and vehicles are both kept sorted
+    by cell number and a query looks up each row of its box with one
+    binary search, then tests the candidates exactly. Points outside the
+    network fall in the border cells.
+
+    Segments are binned once by attach. Vehicles are binned again, with
+    one vectorized sort, by the first query after the simulation moved.
+    """
+    def __init__(self, config={}):
+        self.set_default_config()
+
+        for attr, value in config.items():
+            setattr(self, attr, value)
+
+    def set_default_config(self):
+        # Side of a grid cell in metres
+        self.cell_size = 50
+
+    def attach(self, sim):
+        """
+        Lay the grid over the network of a simulation and bin its road
+        segments.
+        """
+        self.sim = sim
+        geometry = sim.geometry
+        points = geometry.points
+        self.origin = points.min(axis=0)
+        self.columns, self.rows = ((points.max(axis=0) - self.origin) // self.cell_size).astype(np.int64) + 1
+        # Small keys are sorted with a radix sort
+        self.key_type = np.uint16 if self.columns * self.rows <= 2**16 else np.int64
+
+        # Segments join consecutive points of the same road
+        first = np.ones(len(points), dtype=bool)
+        first[geometry.offsets[1:] - 1] = False
+        start = np.flatnonzero(first)
+        self.segment_start = points[start]
+        self.segment_end = points[start + 1]
+        counts = np.diff(geometry.offsets) - 1
+        self.segment_road = np.repeat(sim.network.road_ids, counts)
+
+        # One entry per cell overlapped by the bounding box of a segment
+        x0, y0 = self.cell(*np.minimum(self.segment_start, self.segment_end).T)
+        x1, y1 = self.cell(*np.maximum(self.segment_start, self.segment_end).T)
+        width = x1 - x0 + 1
+        cells = width * (y1 - y0 + 1)
+        segment = np.repeat(np.arange(len(start)), cells)
+        k = np.arange(cells.sum()) - np.repeat(np.cumsum(cells) - cells, cells)
+        keys = ((y0[segment] + k // width[segment]) * self.columns + x0[segment] + k % width[segment]).astype(self.key_type)
+        order = np.argsort(keys, kind="stable")
+        self.segment_keys = keys[order]
+        self.segment_cells = segment[order]
+
+        self.binned = None
+
+    def cell(self, x, y):
+        """
+        Return the grid column and row of points, clipped to the grid.
+        """
+        column = np.clip((np.asarray(x) - self.origin[0]) // self.cell_size, 0, self.columns - 1).astype(np.int64)
+        row = np.clip((np.asarray(y) - self.origin[1]) // self.cell_size, 0, self.rows - 1).astype(np.int64)
+        return column, row
+
+    def update(self):
+        """
+        Bin the current vehicle positions, unless they already are.
+        """
+        sim = self.sim
+        state = (sim.t, sim.next_vehicle_id, sim.completed_trips)
+        if state == self.binned:
+            return
+        ids, x, y, _ = sim.vehicle_columns()
+        column, row = self.cell(x, y)
+        keys = (row * self.columns + column).astype(self.key_type)
+        order = np.argsort(keys, kind="stable")
+        self.vehicle_keys = keys[order]
+        self.vehicle_ids = ids[order]
+        self.vehicle_x = x[order]
+        self.vehicle_y = y[order]
+        self.binned = state
+
+    def lookup(self, keys, x0, y0, x1, y1):
+        """
+        Return the positions in the sorted keys of every entry in the
+        cells overlapping a box.
+        """
+        column0, row0 = self.cell(x0, y0)
+        column1, row1 = self.cell(x1, y1)
+        rows = np.arange(row0, row1 + 1) * self.columns
+        start = np.searchsorted(keys, (rows + column0).astype(self.key_type), side="left")
+        end = np.searchsorted(keys, (rows + column1).astype(self.key_type), side="right")
+        counts = end - start
+        return np.arange(counts.sum()) + np.repeat(start - (np.cumsum(counts) - counts), counts)
+
+    def vehicles_within(self, x, y, radius):
+        """
+        Return the ids of the vehicles within radius of (x, y).
+        """
+        self.update()
+        k = self.lookup(self.vehicle_keys, x - radius, y - radius, x + radius, y + radius)
+        dx = self.vehicle_x[k] - x
+        dy = self.vehicle_y[k] - y
+        return self.vehicle_ids[k[dx * dx + dy * dy <= radius * radius]]
+
+    def vehicles_in_box(self, x0, y0, x1, y1):
+        """
+        Return the ids of the vehicles inside the box from (x0, y0) to
+        (x1, y1).
+        """
+        self.update()
+        k = self.lookup(self.vehicle_keys, x0, y0, x1, y1)
+        x = self.vehicle_x[k]
+        y = self.vehicle_y[k]
+        return self.vehicle_ids[k[(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)]]
+
+    def roads_in_box(self, x0, y0, x1, y1):
+        """
+        Return the sorted ids of the roads whose centre line intersects
+        the box from (x0, y0) to (x1, y1).
+        """
+        segment = np.unique(self.segment_cells[self.lookup(self.segment_keys, x0, y0, x1, y1)])
+        a = self.segment_start[segment]
+        b = self.segment_end[segment]
+        overlap = (
+            (np.minimum(a[:, 0], b[:, 0]) <= x1) & (np.maximum(a[:, 0], b[:, 0]) >= x0)
+            & (np.minimum(a[:, 1], b[:, 1]) <= y1) & (np.maximum(a[:, 1], b[:, 1]) >= y0)
+        )
+        # The segment crosses the box unless every corner is strictly on
+        # the same side of its line
+        corners = np.array([(x0, y0), (x1, y0), (x0, y1), (x1, y1)], dtype=float)
+        direction = b - a
+        side = direction[:, None, 0] * (corners[None, :, 1] - a[:, None, 1]) - direction[:, None, 1] * (corners[None, :, 0] - a[:, None, 0])
+        crossed = ~((side > 0).all(axis=1) | (side < 0).all(axis=1))
+        return np.unique(self.segment_road[segment[overlap & crossed]])
@@ -0,0 +1,66 @@
+import random
+
+import numpy as np
+import pytest
+
+from benchmark import grid_network, random_walk
+from network import compile_network
+from simulation import Simulation
+
+
+def state(sim):
+    ids, road, x, lane = sim.vehicle_state()
+    order = np.argsort(ids)
+    return ids[order], road[order], x[order], lane[order]
+
+
+def run_default(max_dt, seconds=10):
+    sim = Simulation({"vectorized": True, "seed": 0, "collect_data": False, "max_dt": max_dt})
+    sim.generate_model(200)
+    while sim.t < seconds - 1e-9:
+        sim.step()
+    return sim
+
+
+def run_grid(vectorized, max_dt, seconds=60, vehicles=30):
+    # Without signals most roads of the grid are free, so they take whole
+    # macro steps
+    sim = Simulation({
+        "vectorized": vectorized, "seed": 0, "collect_data": False, "max_dt": max_dt,
+        "network": compile_network(grid_network(6)), "traffic_signals": False,
+    })
+    sim.generate_model(0)
+    rng = random.Random(0)
+    for road in rng.sample(sim.roads, vehicles):
+        sim.spawn(random_walk(sim, road.unique_id, 1000, rng))
+    while sim.t < seconds - 1e-9:
+        sim.step()
+    return sim
+
+
+@pytest.mark.parametrize("max_dt", [1 / 60, 0.5, 5])
+def test_sub_stepped_roads_match_fixed_steps(max_dt):
+    # The default network is dense enough that every road is sub-stepped
+    fixed = state(run_default(None))
+    adaptive = state(run_default(max_dt))
+    for a, b in zip(fixed, adaptive):
+        assert np.array_equal(a, b)
+
+
+@pytest.mark.parametrize("max_dt", [0.5, 2, 5])
+def test_large_steps_stay_stable(max_dt):
+    objects = run_grid(False, max_dt)
+    engine = run_grid(True, max_dt)
+
+    for a, b in zip(state(objects)[:2], state(engine)[:2]):
+        assert np.array_equal(a, b)
+    np.testing.assert_allclose(state(engine)[2], state(objects)[2], rtol=0, atol=1e-9)
+
+    for road in objects.roads:
+        for queue in road.lanes:
+            x = np.array([vehicle.x for vehicle in queue])
+            v = np.array([vehicle.v for vehicle in queue])
+            assert np.isfinite(x).all() and np.isfinite(v).all()
+            assert (v >= 0).all()
+            # Queues run from the front, so nobody has overtaken
+            assert (np.diff(x) < 0).all()
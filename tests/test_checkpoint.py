@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from demand import DemandModel
+from simulation import Simulation
+
+
+def state(sim):
+    ids, road, x, lane = sim.vehicle_state()
+    order = np.argsort(ids)
+    return ids[order], road[order], x[order], lane[order]
+
+
+@pytest.mark.parametrize("vectorized", [False, True])
+@pytest.mark.parametrize("mode", ["fixed", "actuated"])
+def test_restore_continues_the_run(tmp_path, vectorized, mode):
+    sim = Simulation({
+        "vectorized": vectorized, "seed": 0, "collect_data": False, "signal_config": {"mode": mode},
+        "demand": DemandModel([{"origin": 1, "destination": 30, "rates": [(0, 1800)]}]),
+    })
+    sim.generate_model(100)
+    for _ in range(300):
+        sim.step()
+
+    path = str(tmp_path / "state.ckpt")
+    sim.save(path)
+    restored = Simulation.restore(path)
+    for _ in range(300):
+        sim.step()
+        restored.step()
+
+    assert restored.t == sim.t
+    assert restored.completed_trips == sim.completed_trips
+    assert restored.next_vehicle_id == sim.next_vehicle_id
+    for a, b in zip(state(sim), state(restored)):
+        assert np.array_equal(a, b)
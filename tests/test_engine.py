@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from engine import EngineVehicle
+from simulation import Simulation
+from vehicle import Vehicle
+
+
+def run(vectorized, steps=600, vehicles=200):
+    sim = Simulation({"vectorized": vectorized, "seed": 0, "collect_data": False})
+    sim.generate_model(vehicles)
+    for _ in range(steps):
+        sim.step()
+    return sim
+
+
+def state(sim):
+    ids, road, x, lane = sim.vehicle_state()
+    order = np.argsort(ids)
+    return ids[order], road[order], x[order], lane[order]
+
+
+def test_engine_matches_objects():
+    objects = state(run(False))
+    engine = state(run(True))
+
+    for name, a, b in zip(("ids", "roads", "lanes"), objects[:2] + objects[3:], engine[:2] + engine[3:]):
+        assert np.array_equal(a, b), name
+    np.testing.assert_allclose(engine[2], objects[2], rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize("vectorized", [False, True])
+def test_retired_vehicles_are_plain(vectorized):
+    sim = run(vectorized, steps=0, vehicles=1)
+    vehicle = sim.schedule.agents[0]
+    assert type(vehicle) is (EngineVehicle if vectorized else Vehicle)
+
+    sim.retire(vehicle)
+    assert type(vehicle) is Vehicle
+    assert "x" in vehicle.__dict__
@@ -0,0 +1,23 @@
+import numpy as np
+
+from recorder import TrajectoryReader, TrajectoryRecorder
+
+
+def record(path, ids):
+    with TrajectoryRecorder(path) as recorder:
+        for t in range(3):
+            n = len(ids)
+            recorder.append(t, np.array(ids), np.full(n, t), np.zeros(n), np.ones(n))
+
+
+def test_recording_again_replaces_the_index(tmp_path):
+    path = str(tmp_path)
+    record(path, [1, 2])
+    assert TrajectoryReader(path).vehicle_ids().tolist() == [1, 2]
+
+    record(path, [7, 8])
+    reader = TrajectoryReader(path)
+    assert reader.vehicle_ids().tolist() == [7, 8]
+    t, x, y, road = reader.vehicle(7)
+    assert t.tolist() == [0, 1, 2]
+    assert x.tolist() == [0, 1, 2]
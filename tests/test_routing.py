@@ -0,0 +1,28 @@
+from network import compile_network
+from routing import Rerouter
+from simulation import Simulation
+
+
+def diamond():
+    # Road 1 leads to 4 either through the long road 2 or the short road 3
+    return compile_network({
+        "roads": [
+            {"id": 1, "start": [0, 0], "end": [100, 0]},
+            {"id": 2, "start": [100, 0], "end": [100, 500], "control": [600, 250]},
+            {"id": 3, "start": [100, 0], "end": [100, 500]},
+            {"id": 4, "start": [100, 500], "end": [0, 500]},
+            {"id": 5, "start": [0, 500], "end": [0, 0]},
+        ],
+        "connections": [[1, 2], [1, 3], [2, 4], [3, 4], [4, 5], [5, 1]],
+    })
+
+
+def test_reroute_list_path():
+    sim = Simulation({"network": diamond(), "traffic_signals": False, "rerouter": Rerouter(), "seed": 0})
+    sim.generate_model(0)
+    vehicle = sim.spawn([1, 2, 4, 5])
+
+    sim.rerouter.reroute(sim)
+
+    assert tuple(vehicle.path) == (1, 3, 4, 5)
+    assert sim.rerouter.rerouted == 1
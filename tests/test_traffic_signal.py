@@ -0,0 +1,26 @@
+from network import compile_network
+from simulation import Simulation
+
+
+def merge():
+    # Roads 1, 2 and 3 merge into road 4, which leads back to road 1
+    return compile_network({
+        "roads": [
+            {"id": 1, "start": [0, 100], "end": [100, 0]},
+            {"id": 2, "start": [0, 0], "end": [100, 0]},
+            {"id": 3, "start": [0, -100], "end": [100, 0]},
+            {"id": 4, "start": [100, 0], "end": [0, 100]},
+        ],
+        "connections": [[1, 4], [2, 4], [3, 4], [4, 1]],
+    })
+
+
+def test_zero_length_phase_is_skipped():
+    sim = Simulation({"network": merge(), "signal_config": {"phase_durations": [30, 0, 30]}})
+    sim.generate_model(0)
+    controller = sim.signals
+    approaches = [sim.road_by_id[road_id].index for road_id in (1, 2, 3)]
+
+    for t, green in [(0, 0), (29, 0), (30, 2), (45, 2), (59, 2), (60, 0)]:
+        controller.update(t)
+        assert controller.road_green[approaches].tolist() == [i == green for i in range(3)], t
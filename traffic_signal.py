@@ -1,6 +1,6 @@
-from mesa import Agent
+import numpy as np
 
-class TrafficSignal(Agent):
+class TrafficSignal:
     """
     A traffic signal agent.
     """
@@ -17,6 +17,22 @@ class TrafficSignal(Agent):
 
     def set_default_config(self):
         self.cycle_length = [(False, True), (True, False)]
+        # Seconds each entry of cycle_length lasts, 30 s each by default
+        self.phase_durations = None
+        # Seconds the cycle is shifted by
+        self.offset = 0
+        # "fixed" follows phase_durations, "actuated" ends a green early
+        # when its approaches are empty and another approach has a queue
+        self.mode = "fixed"
+        self.min_green = 10
+        self.max_green = 60
+        # Vehicles closer than this to the stop line are detected
+        self.detection_distance = 60
+        # Detected vehicles slower than this are queued
+        self.queue_speed = 2
+        # A moving vehicle this many seconds from the stop line keeps the
+        # green
+        self.passage_time = 3
         self.slow_distance = 50
         self.slow_factor = 0.4
         self.stop_distance = 15
@@ -26,6 +42,11 @@ class TrafficSignal(Agent):
         self.last_t = 0
 
     def init_properties(self):
+        if self.phase_durations is None:
+            self.phase_durations = [30] * len(self.cycle_length)
+        if len(self.phase_durations) != len(self.cycle_length):
+            raise ValueError("signal %r has %d phase durations for %d phases" % (
+                self.unique_id, len(self.phase_durations), len(self.cycle_length)))
         for i in range(len(self.roads)):
             for road in self.roads[i]:
                 road.set_traffic_signal(self, i)
@@ -34,8 +55,175 @@ class TrafficSignal(Agent):
     def current_cycle(self):
         return self.cycle_length[self.current_cycle_index]
 
-    def step(self, sim):
-        cycle_length = 30
-        k = (sim.t // cycle_length) % 2
-        self.current_cycle_index = int(k)
+    def green_start(self, group):
+        """
+        Return when, within the cycle, the first green of a group starts.
+        """
+        start = 0
+        for phase, duration in zip(self.cycle_length, self.phase_durations):
+            if phase[group]:
+                return start
+            start += duration
+        return 0
 
+
+class SignalController:
+    """
+    Evaluates every traffic signal of a simulation at once.
+
+    Fixed signals are looked up with array operations, and only when at
+    least one of them reaches the end of its phase; between changes a tick
+    costs one comparison however many signals there are. Actuated signals
+    are re-evaluated every actuation_interval seconds from the queues on
+    their approaches.
+    """
+    actuation_interval = 1
+
+    def __init__(self, signals, roads):
+        self.signals = signals
+        self.roads = roads
+
+        n = len(signals)
+        phases = max([len(signal.cycle_length) for signal in signals], default=1)
+        groups = max([len(signal.roads) for signal in signals], default=1)
+
+        durations = np.zeros((n, phases))
+        self.green = np.zeros((n, phases, groups), dtype=bool)
+        self.offset = np.zeros(n)
+        for i, signal in enumerate(signals):
+            durations[i, :len(signal.phase_durations)] = signal.phase_durations
+            self.green[i, :len(signal.cycle_length), :len(signal.roads)] = signal.cycle_length
+            self.offset[i] = signal.offset
+        self.phase_count = np.array([len(signal.cycle_length) for signal in signals], dtype=np.int64)
+        self.cycle_time = durations.sum(axis=1)
+        # End of each phase within the cycle; padding phases never start,
+        # zero-length phases end as they start and are skipped
+        self.phase_end = np.cumsum(durations, axis=1)
+        self.phase_end[np.arange(phases)[None, :] >= self.phase_count[:, None]] = np.inf
+
+        signal_index = {id(signal): i for i, signal in enumerate(signals)}
+        self.road_signal = np.full(len(roads), -1, dtype=np.int64)
+        self.road_group = np.zeros(len(roads), dtype=np.int64)
+        self.road_slow_distance = np.zeros(len(roads))
+        self.road_slow_factor = np.ones(len(roads))
+        self.road_stop_distance = np.zeros(len(roads))
+        for road in roads:
+            if road.has_traffic_signal:
+                self.road_signal[road.index] = signal_index[id(road.traffic_signal)]
+                self.road_group[road.index] = road.traffic_signal_group
+                self.road_slow_distance[road.index] = road.traffic_signal.slow_distance
+                self.road_slow_factor[road.index] = road.traffic_signal.slow_factor
+                self.road_stop_distance[road.index] = road.traffic_signal.stop_distance
+        self.signaled = np.flatnonzero(self.road_signal >= 0)
+
+        self.actuated = np.array([signal.mode == "actuated" for signal in signals], dtype=bool)
+        self.min_green = np.array([signal.min_green for signal in signals], dtype=float)
+        self.max_green = np.array([signal.max_green for signal in signals], dtype=float)
+        self.road_detection = np.zeros(len(roads))
+        self.road_queue_speed = np.zeros(len(roads))
+        self.road_passage_time = np.zeros(len(roads))
+        for i in self.signaled:
+            signal = signals[self.road_signal[i]]
+            self.road_detection[i] = signal.detection_distance
+            self.road_queue_speed[i] = signal.queue_speed
+            self.road_passage_time[i] = signal.passage_time
+        self.actuated_roads = self.signaled[self.actuated[self.road_signal[self.signaled]]]
+
+        self.road_green = np.ones(len(roads), dtype=bool)
+        self.phase = np.full(n, -1, dtype=np.int64)
+        self.phase_start = np.zeros(n)
+        self.next_change = -np.inf
+        self.next_actuation = -np.inf
+
+    def set_offset(self, signal, offset):
+        signal.offset = offset
+        self.offset[self.signals.index(signal)] = offset
+        self.next_change = -np.inf
+
+    def update(self, t, sim=None):
+        """
+        Bring every signal and road_green up to date with time t. Actuated
+        signals need the simulation to measure their approaches.
+        """
+        if len(self.signals) == 0:
+            return
+        # Actuated signals start in their first phase
+        phase = np.where(self.actuated & (self.phase < 0), 0, self.phase)
+
+        if t >= self.next_change:
+            local = (t + self.offset) % self.cycle_time
+            fixed = (self.phase_end <= local[:, None]).sum(axis=1)
+            phase = np.where(self.actuated, phase, fixed)
+            remaining = self.phase_end[np.arange(len(phase)), fixed] - local
+            remaining[self.actuated] = np.inf
+            self.next_change = t + remaining.min()
+
+        if sim is not None and self.actuated.any() and t >= self.next_actuation:
+            phase = self.actuate(t, sim, phase)
+            self.next_actuation = t + self.actuation_interval
+
+        changed = np.flatnonzero(phase != self.phase)
+        if len(changed) == 0:
+            return
+        for i in changed:
+            self.signals[i].current_cycle_index = int(phase[i])
+        self.phase = phase
+        self.phase_start[changed] = t
+
+        signal = self.road_signal[self.signaled]
+        self.road_green[self.signaled] = self.green[signal, phase[signal], self.road_group[self.signaled]]
+
+    def measure(self, sim):
+        """
+        Return, for every road, how many detected vehicles are queued and
+        how many are moving and will reach the stop line within the
+        passage time.
+        """
+        queue = np.zeros(len(self.roads))
+        arriving = np.zeros(len(self.roads))
+
+        engine = sim.engine
+        if engine is not None:
+            n = engine.size
+            road = engine.road[:n]
+            v = engine.v[:n]
+            to_end = engine.road_length[road] - engine.x[:n]
+            detected = engine.active[:n] & (to_end <= self.road_detection[road])
+            queued = detected & (v < self.road_queue_speed[road])
+            moving = detected & ~queued & (to_end <= v * self.road_passage_time[road])
+            queue += np.bincount(road[queued], minlength=len(self.roads))
+            arriving += np.bincount(road[moving], minlength=len(self.roads))
+            return queue, arriving
+
+        for i in self.actuated_roads:
+            road = self.roads[i]
+            for lane in road.lanes:
+                for vehicle in lane:
+                    to_end = road.length - vehicle.x
+                    if to_end > self.road_detection[i]:
+                        break
+                    if vehicle.v < self.road_queue_speed[i]:
+                        queue[i] += 1
+                    elif to_end <= vehicle.v * self.road_passage_time[i]:
+                        arriving[i] += 1
+        return queue, arriving
+
+    def actuate(self, t, sim, phase):
+        """
+        Move actuated signals to their next phase when no vehicle is about
+        to cross on a green approach, or the green has lasted max_green,
+        while another approach has a queue.
+        """
+        queue, arriving = self.measure(sim)
+        roads = self.signaled
+        signal = self.road_signal[roads]
+        green = self.green[signal, phase[signal], self.road_group[roads]]
+
+        n = len(self.signals)
+        green_demand = np.bincount(signal, weights=arriving[roads] * green, minlength=n)
+        red_queue = np.bincount(signal, weights=queue[roads] * ~green, minlength=n)
+
+        elapsed = t - self.phase_start
+        done = (elapsed >= self.max_green) | ((elapsed >= self.min_green) & (green_demand == 0))
+        change = self.actuated & (red_queue > 0) & done
+        return np.where(change, (phase + 1) % self.phase_count, phase)
@@ -1,13 +1,19 @@
-from mesa import Agent
+from lanes import MIN_GAP
 import numpy as np
 
-class Vehicle(Agent):
+class Vehicle:
     """
     A vehicle agent.
     """
     def __init__(self, unique_id, model, config={}):
-        self.unique_id = unique_id
         self.model = model
+        self.reset(unique_id, config)
+
+    def reset(self, unique_id, config={}):
+        """
+        Give the vehicle a new identity, so retired vehicles can be reused.
+        """
+        self.unique_id = unique_id
         self.set_default_config()
 
         for attr, value in config.items():
@@ -25,6 +31,8 @@ class Vehicle(Agent):
 
         self.path = []
         self.current_road_index = 0
+        self.lane = 0
+        self.departure_time = 0
 
         self.x = 0
         self.v = self.v_max
@@ -35,7 +43,11 @@ class Vehicle(Agent):
         self.sqrt_ab = 2 * np.sqrt(self.a_max * self.b_max)
         self._v_max = self.v_max
 
-    def step(self, dt):
+    def step(self, dt, lead=None, offset=0):
+        """
+        Advance the vehicle by dt following the vehicle `lead` ahead of it.
+        `offset` is added to lead.x when the leader is on the next road.
+        """
         if self.v + self.a*dt < 0:
             self.x -= 1/2*self.v*self.v/self.a
             self.v = 0
@@ -44,6 +56,10 @@ class Vehicle(Agent):
             self.x += self.v*dt + self.a*dt*dt/2
         # Update acceleration
         alpha = 0
+        if lead is not None:
+            delta_x = max(lead.x + offset - self.x - lead.l, MIN_GAP)
+            delta_v = self.v - lead.v
+            alpha = (self.s0 + max(0, self.T*self.v + delta_v*self.v/self.sqrt_ab)) / delta_x
         self.a = self.a_max * (1-(self.v/self.v_max)**4 - alpha**2)
 
         if self.stopped: 